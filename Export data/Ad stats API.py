@@ -0,0 +1,110 @@
+"""Сводная статистика по рекламе VK и Google Ads за один запуск (источники см. ad_sources.py)
+
+@field upd_key составной ключ для инкремента
+@field source Источник: vk или google
+@field date Дата за которую предоставлена статистика
+@field account_id Идентификатор аккаунта (клиент VK, кабинет Google Ads)
+@field account_name Название аккаунта
+@field currency_code Валюта аккаунта, если источник ее отдает
+@field campaign_id Идентификатор кампании
+@field campaign_name Название кампании
+@field ad_id Идентификатор объявления (0 для кампаний Performance Max)
+@field ad_name Название объявления
+@field cost Расходы в валюте аккаунта
+@field impressions Показы
+@field clicks Клики
+"""
+
+import logging
+from datetime import datetime, timedelta
+from ad_sources import VkAdSource, GoogleAdSource, run_sources, AD_STATS_KEY_COLUMNS
+from google_ads import creeds_from_connection
+from batch_sink import BatchSink
+from row_keys import RowIndex, confirm_callback
+import instrumentation
+
+
+def get_creeds(login_customer_id=None) -> dict:
+    """
+    Функция возвращает креды Google Ads для создания клиента
+    @param login_customer_id: Идентификатор зависит от аккаунта к которому осуществляются запросы
+    @type login_customer_id: str
+    @rtype: dict
+    """
+    hook = HttpHook(http_conn_id='google_ads_new', method='GET')
+    return creeds_from_connection(hook.get_connection('google_ads_new'), login_customer_id)
+
+
+def main():
+    """
+    Статистика всех источников за последние 3 дня, не включая текущий. Источники выгружаются параллельно,
+    результат - генератор фреймов по аккаунтам
+    """
+    date_from = (datetime.now() - timedelta(days=3)).strftime("%Y-%m-%d")
+    date_to = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
+    # Партиции запуска, повторный запуск в тот же день продолжает выгрузку
+    sink = BatchSink('ad_stats')
+    sink.purge_stale_runs()
+    # Ключи и хэши строк прошлых запусков для отбора изменившихся строк
+    row_index = RowIndex('ad_stats', AD_STATS_KEY_COLUMNS, key_column='upd_key', date_column='date')
+
+    rows = run_sources([VkAdSource(), GoogleAdSource(get_creeds)], date_from, date_to, sink, row_index)
+    logging.info(f"Written rows {rows}")
+
+    instrumentation.write_summary('ad_stats')
+    return row_index.commit_after(sink.iter_batches(), min_date=date_from)
+
+
+_target_sql = '''
+select
+    upd_key,
+    source,
+    date::date,
+    account_id::bigint,
+    account_name,
+    currency_code,
+    campaign_id::bigint,
+    campaign_name,
+    ad_id::bigint,
+    ad_name,
+    cost::float,
+    impressions::bigint,
+    clicks::bigint
+from [[ad_stats]]
+;'''
+
+fields_types = {
+    'upd_key': Type.VARCHAR,
+    'source': Type.VARCHAR,
+    'date': Type.DATE,
+    'account_id': Type.BIGINT,
+    'account_name': Type.VARCHAR,
+    'currency_code': Type.VARCHAR,
+    'campaign_id': Type.BIGINT,
+    'campaign_name': Type.VARCHAR,
+    'ad_id': Type.BIGINT,
+    'ad_name': Type.VARCHAR,
+    'cost': Type.FLOAT,
+    'impressions': Type.BIGINT,
+    'clicks': Type.BIGINT
+}
+
+tpl = EntityBuilderTemplate(
+    User.Efremov,
+    is_incremental=True,
+    update_key='upd_key',
+    schedule_interval='0 5 * * *',
+    fields=fields_types,
+    query=_target_sql
+)
+
+tpl.add_stage(Stage([
+    FetchListSourceOperator(name='ad_stats',
+                            python_callable=main,
+                            types=fields_types
+                            )
+]))
+dag = tpl.DAG()
+# Индекс строк становится действующим только после успешной загрузки (см. row_keys.py)
+dag.on_success_callback = confirm_callback('ad_stats')
+dag.max_active_runs = 1
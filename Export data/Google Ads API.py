@@ -1,11 +1,17 @@
 """ Данные по Google-рекламе (обновленная выгрузка на новом API)
 Описание полей можно найти в документации https://developers.google.com/google-ads/api/fields/v7/ad_group_ad
+Состав выгружаемых полей задается реестром отчетов REPORTS (google_ads.py)
 """
 
-import pandas as pd
 import logging
-from datetime import datetime, timedelta, date
-from google.ads.googleads.client import GoogleAdsClient
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from batch_sink import BatchSink
+from row_keys import RowIndex, confirm_callback
+import instrumentation
+from frame_schema import schema_from_fields, cast_frame
+from google_ads import (REPORTS, HIERARCHY_CACHE_TTL, creeds_from_connection, create_client, get_cabinet_data,
+                        is_permanent_error, load_account_cache, refresh_account_cache)
 
 
 def get_creeds(login_customer_id=None) -> dict:
@@ -18,388 +24,7 @@ def get_creeds(login_customer_id=None) -> dict:
     """
     hook = HttpHook(http_conn_id='google_ads_new', method='GET')
     conn = hook.get_connection('google_ads_new')
-
-    cred_dict = {
-        'developer_token': conn.extra_dejson.get('developer_token'),
-        'refresh_token': conn.extra_dejson.get('refresh_token'),
-        'client_id': conn.extra_dejson.get('client_id'),
-        'client_secret': conn.extra_dejson.get('client_secret'),
-        'access_token': conn.extra_dejson.get('access_token'),
-        'use_proto_plus': True,
-        'login_customer_id': login_customer_id
-    }
-    return cred_dict
-
-
-def create_client(cred_dict, _version="v9") -> object:
-    """
-    Функция для создания класса клиента, по которому в дальнейшим осуществляется запросы
-    @param cred_dict: Словарь кредов получается функцией get_creeds
-    @type cred_dict: dict
-    @param _version: Версия API
-    @type _version: str
-    @return: Класс для обращений к API
-    @rtype: object
-    """
-    try:
-        client = GoogleAdsClient.load_from_dict(cred_dict, version=_version)
-        return client
-    except Exception as e:
-        logging.error(f"Create client Failed \nPlease check function 'create_client'\n{e}")
-
-
-def _account_hierarchy(customer_client, customer_ids_to_child_accounts) -> dict:
-    """
-    Функция для парсинга иерархии аккаунта
-    @param customer_client: Класс клиента
-    @type customer_client: object
-    @param customer_ids_to_child_accounts: Класс кабинетов клиента
-    @type customer_ids_to_child_accounts: object
-    @return: Словарь клиента со списком всех входящих кабинетов
-    @rtype: dict
-    """
-    # проверка на наличие клиентов у аккаунта
-    if len(customer_ids_to_child_accounts) > 0:
-        dict_customer_client = {
-            'client_id': customer_client.id,
-            'client_name': customer_client.descriptive_name,
-            'customers_client': []
-        }
-        for child_account in customer_ids_to_child_accounts[customer_client.id]:
-            dict_child_account = {
-                'id': child_account.id,
-                'name': child_account.descriptive_name,
-                'currency_code': child_account.currency_code,
-                'time_zone': child_account.time_zone
-            }
-            dict_customer_client['customers_client'].append(dict_child_account)
-    # Если у аккаунта нет клиентов - в качестве клиента возвращаем сам аккаунт
-    else:
-        dict_customer_client = {
-            'client_id': customer_client.id,
-            'client_name': customer_client.descriptive_name,
-            'customers_client': [
-                {
-                    'id': customer_client.id,
-                    'name': customer_client.descriptive_name,
-                    'currency_code': customer_client.currency_code,
-                    'time_zone': customer_client.time_zone
-                }
-            ]
-        }
-    return dict_customer_client
-
-
-def get_account_list(client, login_customer_id=None) -> list:
-    """
-    Функция для получения иерархии аккаунта
-    @param client: Клиент к которому осуществляются запросы, получается из create_client
-    @type client: object
-    @param login_customer_id: Идентификатор клиента, если нужно получить по конкретному,
-     если None - возвращает по всем доступным
-    @type login_customer_id: str
-    @return: Список словарей с иерархией аккаунта
-    @rtype: list
-    """
-
-    # Получает экземпляры клиентов GoogleAdsService и CustomerService.
-    googleads_service = client.get_service("GoogleAdsService")
-    customer_service = client.get_service("CustomerService")
-
-    # Лист идентификаторов клиентов для обработки.
-    seed_customer_ids = []
-
-    # Создает запрос, который извлекает все дочерние учетные записи менеджера.
-    query = """
-        SELECT
-          customer_client.client_customer,
-          customer_client.level,
-          customer_client.manager,
-          customer_client.descriptive_name,
-          customer_client.currency_code,
-          customer_client.time_zone,
-          customer_client.id
-        FROM customer_client
-        WHERE customer_client.level <= 1"""
-
-    # Если идентификатор менеджера был указан в параметре customerId, он будет единственным идентификатором в списке.
-    # В противном случае мы отправим запрос для всех клиентов,
-    # доступных для этой аутентифицированной учетной записи Google.
-    if login_customer_id is not None:
-        seed_customer_ids = [login_customer_id]
-    else:
-        logging.info(
-            "No manager ID is specified. The example will print the "
-            "hierarchies of all accessible customer IDs."
-        )
-
-        customer_resource_names = (
-            customer_service.list_accessible_customers().resource_names
-        )
-
-        for customer_resource_name in customer_resource_names:
-            customer_id = googleads_service.parse_customer_path(
-                customer_resource_name
-            )["customer_id"]
-            logging.info(customer_id)
-            seed_customer_ids.append(customer_id)
-    list_hierarchy = []
-    for seed_customer_id in seed_customer_ids:
-        unprocessed_customer_ids = [seed_customer_id]
-        customer_ids_to_child_accounts = dict()
-        root_customer_client = None
-
-        while unprocessed_customer_ids:
-            customer_id = int(unprocessed_customer_ids.pop(0))
-            response = googleads_service.search(
-                customer_id=str(customer_id), query=query
-            )
-
-            # Выполняет итерацию по всем строкам на всех страницах,
-            # чтобы получить все кабинеты клиентов
-            for googleads_row in response:
-                customer_client = googleads_row.customer_client
-
-                # Кабинет клиента, который с уровнем 0 является указанным Кабинет
-                if customer_client.level == 0:
-                    if root_customer_client is None:
-                        root_customer_client = customer_client
-                    continue
-
-                if customer_id not in customer_ids_to_child_accounts:
-                    customer_ids_to_child_accounts[customer_id] = []
-
-                customer_ids_to_child_accounts[customer_id].append(
-                    customer_client
-                )
-
-                if customer_client.manager:
-                    # Клиентом могут управлять несколько менеджеров, поэтому
-                    # предотвратить посещение одного и того же клиента много раз, мы
-                    # проверяем, есть ли он уже в словаре.
-                    if (
-                            customer_client.id not in customer_ids_to_child_accounts
-                            and customer_client.level == 1
-                    ):
-                        unprocessed_customer_ids.append(customer_client.id)
-
-        if root_customer_client is not None:
-            logging.info(
-                "The hierarchy of customer ID "
-                f"{root_customer_client.id} is printed below:"
-            )
-            list_hierarchy.append(_account_hierarchy(root_customer_client, customer_ids_to_child_accounts))
-        else:
-            logging.info(
-                f"Customer ID {login_customer_id} is likely a test "
-                "account, so its customer client information cannot be "
-                "retrieved."
-            )
-    return list_hierarchy
-
-
-def get_ads_data(client, account_id, start_date, end_date) -> pd.DataFrame:
-    """
-    Функция для получения данных по аккаунту. Для добавление новых метрик нужно
-    1. Добавить их в запрос (query)
-    2. Добавить в словарь (tmp_dict)
-    Документация https://developers.google.com/google-ads/api/fields/v7/ad_group_ad
-
-    @param client: Объект клиента из функции create_client
-    @type client: object
-    @param account_id: Идентификатор РК
-    @type account_id: str
-    @param start_date: Дата начала в формате 'YYYY-MM-DD'
-    @type start_date: str
-    @param end_date: Дата окончания в формате 'YYYY-MM-DD'
-    @type end_date: str
-    @return: Возвращает pd.DataFrame с данными в разрезе объявлений
-    @rtype: pd.DataFrame
-    """
-    ga_service = client.get_service("GoogleAdsService")
-
-    query = """
-    SELECT
-      -- Кампании
-      campaign.id,
-      campaign.name,
-      campaign.status,
-      -- Группа объявлений
-      ad_group.name,
-      ad_group.id,
-      ad_group.status,
-      ad_group_ad.labels,
-      -- Объявления
-      ad_group_ad.ad.id,
-      ad_group_ad.ad.type, 
-      ad_group_ad.ad.tracking_url_template,
-      ad_group_ad.ad.device_preference,
-      ad_group_ad.ad.expanded_text_ad.description,
-      ad_group_ad.ad.expanded_text_ad.description2,
-      ad_group_ad.ad.display_url,
-      ad_group_ad.ad.expanded_text_ad.headline_part1,
-      ad_group_ad.ad.expanded_text_ad.headline_part2,
-      ad_group_ad.ad.expanded_text_ad.headline_part3,
-      -- Метрики
-      metrics.impressions,
-      metrics.clicks,
-      metrics.cost_micros,
-      metrics.all_conversions,
-      metrics.view_through_conversions,
-      -- Сегменты
-      segments.date,
-      segments.ad_network_type,
-      segments.device
-    FROM ad_group_ad
-    WHERE segments.date BETWEEN '""" + str(start_date) + """' AND '""" + str(end_date) + """' -- AND ad_group_ad.status != 'REMOVED'
-    ORDER BY campaign.id
-        """
-    # Получение данных
-    search_request = client.get_type("SearchGoogleAdsStreamRequest")
-    search_request.customer_id = account_id
-    search_request.query = query
-    response = ga_service.search_stream(search_request)
-
-    data_df = pd.DataFrame()
-    try:
-        for batch in response:
-            for row in batch.results:
-                tmp_dict = {'campaign_name': row.campaign.name,
-                            'campaign_id': row.campaign.id,
-                            'campaign_status': row.campaign.status.name,
-                            'ad_group_id': row.ad_group.id,
-                            'ad_group_name': row.ad_group.name,
-                            'ad_group_status': row.ad_group.status.name,
-                            'labels': row.ad_group.labels,
-                            'ad_id': row.ad_group_ad.ad.id,
-                            'ad_type': row.ad_group_ad.ad.type_.name,
-                            'tracking_url_template': row.ad_group_ad.ad.tracking_url_template,
-                            'description': row.ad_group_ad.ad.expanded_text_ad.description,
-                            'description2': row.ad_group_ad.ad.expanded_text_ad.description2,
-                            'display_url': row.ad_group_ad.ad.display_url,
-                            'headline_part1': row.ad_group_ad.ad.expanded_text_ad.headline_part1,
-                            'headline_part2': row.ad_group_ad.ad.expanded_text_ad.headline_part2,
-                            'headline_part3': row.ad_group_ad.ad.expanded_text_ad.headline_part3,
-                            'clicks': row.metrics.clicks,
-                            'impressions': row.metrics.impressions,
-                            'cost': row.metrics.cost_micros / 1000000,
-                            'all_conversions': row.metrics.all_conversions,
-                            'view_through_conversions': row.metrics.view_through_conversions,
-                            'start_date': row.segments.date,
-                            'ad_network_type': row.segments.ad_network_type.name,
-                            'device': row.segments.device.name
-                            }
-                data_df = data_df.append(tmp_dict, ignore_index=True)
-
-        # Приведение к нужным типам
-        data_df['campaign_id'] = data_df['campaign_id'].astype(int)
-        data_df['ad_group_id'] = data_df['ad_group_id'].astype(int)
-        data_df['ad_id'] = data_df['ad_id'].astype(int)
-        data_df['clicks'] = data_df['clicks'].astype(int)
-        data_df['impressions'] = data_df['impressions'].astype(int)
-        data_df['cost'] = data_df['cost'].astype(float)
-        data_df['all_conversions'] = data_df['all_conversions'].astype(int)
-        data_df['view_through_conversions'] = data_df['view_through_conversions'].astype(int)
-
-        return data_df
-    except:
-        return None
-
-
-def get_ads_data_performance(client, account_id, start_date, end_date) -> pd.DataFrame:
-    """
-    Функция для получения данных по аккаунту. Для добавление новых метрик нужно
-    1. Добавить их в запрос (query)
-    2. Добавить в словарь (tmp_dict)
-    Документация https://developers.google.com/google-ads/api/fields/v7/ad_group_ad
-
-    Это отдельная функция для выгрузки Performance Max т.к. они выгружаются только в разрезе кампаний
-    поля с ad_group_id и ad_id сохранены, но будут пустые
-
-    @param client: Объект клиента из функции create_client
-    @type client: object
-    @param account_id: Идентификатор РК
-    @type account_id: str
-    @param start_date: Дата начала в формате 'YYYY-MM-DD'
-    @type start_date: str
-    @param end_date: Дата окончания в формате 'YYYY-MM-DD'
-    @type end_date: str
-    @return: Возвращает pd.DataFrame с данными в разрезе объявлений
-    @rtype: pd.DataFrame
-    """
-    ga_service = client.get_service("GoogleAdsService")
-
-    query = """
-    SELECT
-      -- Кампании
-      campaign.id,
-      campaign.name,
-      campaign.status,
-      -- Метрики
-      metrics.impressions,
-      metrics.clicks,
-      metrics.cost_micros,
-      metrics.all_conversions,
-      metrics.view_through_conversions,
-      -- Сегменты
-      segments.date,
-      segments.ad_network_type,
-      segments.device
-    FROM campaign
-    WHERE segments.date BETWEEN '""" + str(start_date) + """' AND '""" + str(end_date) + """' 
-    and campaign.advertising_channel_type = PERFORMANCE_MAX
-    ORDER BY campaign.id
-        """
-    # Получение данных
-    search_request = client.get_type("SearchGoogleAdsStreamRequest")
-    search_request.customer_id = account_id
-    search_request.query = query
-    response = ga_service.search_stream(search_request)
-
-    data_df = pd.DataFrame()
-    try:
-        for batch in response:
-            for row in batch.results:
-                tmp_dict = {'campaign_name': row.campaign.name,
-                            'campaign_id': row.campaign.id,
-                            'campaign_status': row.campaign.status.name,
-                            'ad_group_id': row.ad_group.id,
-                            'ad_group_name': row.ad_group.name,
-                            'ad_group_status': row.ad_group.status.name,
-                            'labels': row.ad_group.labels,
-                            'ad_id': row.ad_group_ad.ad.id,
-                            'ad_type': row.ad_group_ad.ad.type_.name,
-                            'tracking_url_template': row.ad_group_ad.ad.tracking_url_template,
-                            'description': row.ad_group_ad.ad.expanded_text_ad.description,
-                            'description2': row.ad_group_ad.ad.expanded_text_ad.description2,
-                            'display_url': row.ad_group_ad.ad.display_url,
-                            'headline_part1': row.ad_group_ad.ad.expanded_text_ad.headline_part1,
-                            'headline_part2': row.ad_group_ad.ad.expanded_text_ad.headline_part2,
-                            'headline_part3': row.ad_group_ad.ad.expanded_text_ad.headline_part3,
-                            'clicks': row.metrics.clicks,
-                            'impressions': row.metrics.impressions,
-                            'cost': row.metrics.cost_micros / 1000000,
-                            'all_conversions': row.metrics.all_conversions,
-                            'view_through_conversions': row.metrics.view_through_conversions,
-                            'start_date': row.segments.date,
-                            'ad_network_type': row.segments.ad_network_type.name,
-                            'device': row.segments.device.name
-                            }
-                data_df = data_df.append(tmp_dict, ignore_index=True)
-
-        # Приведение к нужным типам
-        data_df['campaign_id'] = data_df['campaign_id'].astype(int)
-        data_df['ad_group_id'] = data_df['ad_group_id'].astype(int)
-        data_df['ad_id'] = data_df['ad_id'].astype(int)
-        data_df['clicks'] = data_df['clicks'].astype(int)
-        data_df['impressions'] = data_df['impressions'].astype(int)
-        data_df['cost'] = data_df['cost'].astype(float)
-        data_df['all_conversions'] = data_df['all_conversions'].astype(int)
-        data_df['view_through_conversions'] = data_df['view_through_conversions'].astype(int)
-
-        return data_df
-    except:
-        return None
+    return creeds_from_connection(conn, login_customer_id)
 
 
 def get_date_range(start_days=5, stop_days=1) -> list:
@@ -418,37 +43,66 @@ def get_date_range(start_days=5, stop_days=1) -> list:
     return date_generated
 
 
-def main():
-    # Итоговый фрейм для добавления данных
-    df = pd.DataFrame()
-    # Получаем креды
-    creds = get_creeds()
-    # Создаем клиента для получения списка кабинетов
-    client = create_client(creds)
-    # Получаем кабинеты
-    account_hierarchy = get_account_list(client)
-    # Создаем лист дат для итерации
-    list_date = get_date_range(start_days=3)
-    # Итерация по датам
-    for day in list_date:
-        logging.info(f'Start day {day}')
-        # Итерация по клиентам
-        for account in account_hierarchy:
-            logging.info(f"Start account {account['client_id']}")
-            # Создаем клиента для конкретного кабинета
-            account_creeds = get_creeds(login_customer_id=account['client_id'])
-            account_client = create_client(account_creeds)
-            # Итерация по кабинетам
-            for cabinet in account['customers_client']:
-                logging.info(f"Start cabinet {cabinet['id']}")
-                # Датафрейм для записи результатов одной итерации
-                cabinet_df = get_ads_data(account_client, str(cabinet['id']), day, day)
-                # Отдельно выгружаются кампании "максимальной эффективности"
-                cabinet_perf_max_df = get_ads_data_performance(account_client, str(cabinet['id']), day, day)
-                # Объединяем данные
-                if cabinet_df is not None or cabinet_perf_max_df is not None:
-                    cabinet_all_df = pd.concat([cabinet_df, cabinet_perf_max_df])
-                else:
+# Колонки ключа инкремента: строка статистики уникальна в разрезе объявления, дня и сегментов
+_UPD_KEY_COLUMNS = ['account_id', 'cabinet_id', 'date', 'campaign_id', 'ad_group_id', 'ad_id',
+                    'start_date', 'ad_network_type', 'device']
+
+
+def _get_hierarchy_data(account_hierarchy, list_date, processed, sink, row_index) -> tuple:
+    """
+    Функция выгружает данные по всем кабинетам иерархии, которые еще не были обработаны,
+    и записывает их в sink партициями кабинет/день. Уже записанные партиции пропускаются,
+    в партицию попадают только строки, новые или изменившиеся с прошлого запуска.
+    Партиция, в которой не получен хотя бы один отчет, не записывается - ее догрузит повторный запуск.
+    Кабинет с постоянной ошибкой (is_permanent_error) пропускается целиком
+    @param account_hierarchy: Список словарей с иерархией аккаунта
+    @type account_hierarchy: list
+    @param list_date: Список дат
+    @type list_date: list
+    @param processed: Множество пар (client_id, id кабинета), пополняется обработанными кабинетами
+    @type processed: set
+    @param sink: Хранилище партиций запуска
+    @type sink: BatchSink
+    @param row_index: Индекс строк прошлых запусков
+    @type row_index: RowIndex
+    @return: Ключи партиций, которые не удалось выгрузить, и идентификаторы пропущенных кабинетов
+    @rtype: tuple
+    """
+    failed = []
+    skipped = []
+    # Итерация по клиентам
+    for account in account_hierarchy:
+        cabinets = [
+            cabinet for cabinet in account['customers_client']
+            if (account['client_id'], cabinet['id']) not in processed
+        ]
+        if not cabinets:
+            continue
+        logging.info(f"Start account {account['client_id']}")
+        # Создаем клиента для конкретного кабинета
+        account_creeds = get_creeds(login_customer_id=account['client_id'])
+        account_client = create_client(account_creeds)
+        # Итерация по кабинетам
+        for cabinet in cabinets:
+            processed.add((account['client_id'], cabinet['id']))
+            # Итерация по датам
+            for day in list_date:
+                key = f"{account['client_id']}_{cabinet['id']}_{day}"
+                if sink.is_written(key):
+                    logging.info(f"Skip cabinet {cabinet['id']} day {day}, already written")
+                    continue
+                logging.info(f"Start cabinet {cabinet['id']} day {day}")
+                # Объявления и кампании "максимальной эффективности" по кабинету
+                try:
+                    cabinet_all_df = get_cabinet_data(account_client, str(cabinet['id']), day, day)
+                except Exception as e:
+                    if is_permanent_error(e):
+                        logging.warning(f"Cabinet {cabinet['id']} is not available, skipped\n{e}")
+                        instrumentation.incr('skipped_cabinets')
+                        skipped.append(cabinet['id'])
+                        break
+                    logging.error(f"Cabinet {cabinet['id']} day {day} failed, partition is not written\n{e}")
+                    failed.append(key)
                     continue
                 if cabinet_all_df is not None:
                     cabinet_all_df['account_name'] = account['client_name']
@@ -458,69 +112,91 @@ def main():
                     cabinet_all_df['date'] = day
                     cabinet_all_df['currency_code'] = cabinet['currency_code']
                     cabinet_all_df['time_zone'] = cabinet['time_zone']
+                    # Приведение к схеме, колонки, которых нет в отчете, заполняются значениями по умолчанию
+                    cabinet_all_df, _ = cast_frame(cabinet_all_df, _FRAME_SCHEMA, name=key)
+                with instrumentation.span('google.dedup'):
+                    cabinet_all_df = row_index.filter_changed(cabinet_all_df)
+                with instrumentation.span('google.sink_write'):
+                    sink.write(key, cabinet_all_df)
+                if cabinet_all_df is not None:
+                    instrumentation.incr('rows', cabinet_all_df.shape[0])
+    return failed, skipped
 
-                    # Добавляем в финальный фрейм
-                    df = pd.concat([df, cabinet_all_df])
-                else:
-                    continue
-    return df
-
-
-_target_sql = '''
-select
-    md5(account_id+cabinet_id+date::varchar+campaign_id+ad_group_id+ad_id) as upd_key,
-    account_name,
-    account_id,
-    cabinet_name,
-    cabinet_id,
-    date,
-    currency_code,
-    time_zone,
-    campaign_name,
-    campaign_id,
-    campaign_status,
-    ad_group_id,
-    ad_group_name,
-    ad_group_status,
-    labels,
-    ad_id,
-    ad_type,
-    tracking_url_template,
-    description,
-    description2,
-    display_url,
-    headline_part1,
-    headline_part2,
-    headline_part3,
-    clicks,
-    impressions,
-    cost,
-    all_conversions,
-    view_through_conversions,
-    start_date,
-    ad_network_type,
-    device
-from [[ads]]
-;'''
 
-fields_types = {
-    'upd_key': Type.VARCHAR,
+def main():
+    """
+    Выгрузка пишет данные в локальные партиции и возвращает генератор фреймов по кабинетам/дням,
+    поэтому в памяти одновременно находится только одна партиция
+    """
+    # Партиции запуска, повторный запуск в тот же день продолжает выгрузку
+    sink = BatchSink('google_ads')
+    sink.purge_stale_runs()
+    # Ключи и хэши строк прошлых запусков для отбора изменившихся строк
+    row_index = RowIndex('google_ads', _UPD_KEY_COLUMNS, key_column='upd_key', date_column='date')
+    # Получаем креды
+    creds = get_creeds()
+    # Создаем клиента для получения списка кабинетов
+    client = create_client(creds)
+    # Создаем лист дат для итерации
+    list_date = get_date_range(start_days=3)
+    # Получаем кабинеты из кэша. Если кэш устарел - обновляем его в фоне,
+    # а выгрузку начинаем по сохраненным кабинетам
+    account_hierarchy, updated_at = load_account_cache()
+    executor = ThreadPoolExecutor(max_workers=1)
+    refresh = None
+    if account_hierarchy is None:
+        account_hierarchy = refresh_account_cache(client)
+    elif datetime.now() - updated_at > HIERARCHY_CACHE_TTL:
+        logging.info(f"Account hierarchy cache from {updated_at} is stale, refreshing")
+        refresh = instrumentation.submit(executor, refresh_account_cache, client)
+
+    processed = set()
+    failed, skipped = _get_hierarchy_data(account_hierarchy, list_date, processed, sink, row_index)
+    # Догружаем кабинеты, которые появились после обновления иерархии
+    if refresh is not None:
+        try:
+            refresh_failed, refresh_skipped = _get_hierarchy_data(refresh.result(), list_date, processed, sink,
+                                                                  row_index)
+            failed += refresh_failed
+            skipped += refresh_skipped
+        except Exception as e:
+            logging.error(f"Account hierarchy refresh failed\n{e}")
+    executor.shutdown()
+    if skipped:
+        logging.warning(f"Skipped {len(skipped)} unavailable cabinets: {', '.join(map(str, skipped))}")
+
+    instrumentation.write_summary('google_ads')
+    # Записанные партиции сохраняются, повторный запуск догрузит только упавшие из-за временных ошибок
+    if failed:
+        raise Exception(f"Partitions failed: {', '.join(failed)}")
+    return row_index.commit_after(sink.iter_batches(), min_date=list_date[0])
+
+
+# Колонки, которые выгрузка добавляет к колонкам отчетов (см. _get_hierarchy_data)
+_CABINET_FIELDS_TYPES = {
     'account_name': Type.VARCHAR,
     'account_id': Type.VARCHAR,
     'cabinet_name': Type.VARCHAR,
     'cabinet_id': Type.VARCHAR,
     'date': Type.DATE,
     'currency_code': Type.VARCHAR,
-    'time_zone': Type.VARCHAR,
-    'campaign_name': Type.VARCHAR,
+    'time_zone': Type.VARCHAR
+}
+
+# Тип колонки отчета в хранилище по типу значения из REPORTS
+_KIND_TYPES = {
+    'int': Type.INTEGER,
+    'float': Type.FLOAT,
+    'str': Type.VARCHAR,
+    'enum': Type.VARCHAR,
+    'list': Type.VARCHAR
+}
+
+# Колонки отчетов, тип которых в хранилище отличается от типа по значению
+_REPORT_COLUMN_TYPES = {
     'campaign_id': Type.VARCHAR,
-    'campaign_status': Type.VARCHAR,
     'ad_group_id': Type.VARCHAR,
-    'ad_group_name': Type.VARCHAR,
-    'ad_group_status': Type.VARCHAR,
-    'labels': Type.VARCHAR,
     'ad_id': Type.VARCHAR,
-    'ad_type': Type.VARCHAR,
     'tracking_url_template': Type.VARCHAR(32768),
     'description': Type.VARCHAR(32768),
     'description2': Type.VARCHAR(32768),
@@ -528,16 +204,71 @@ fields_types = {
     'headline_part1': Type.VARCHAR(32768),
     'headline_part2': Type.VARCHAR(32768),
     'headline_part3': Type.VARCHAR(32768),
-    'clicks': Type.INTEGER,
-    'impressions': Type.INTEGER,
-    'cost': Type.FLOAT,
-    'all_conversions': Type.INTEGER,
-    'view_through_conversions': Type.INTEGER,
-    'start_date': Type.DATE,
-    'ad_network_type': Type.VARCHAR,
-    'device': Type.VARCHAR
+    'cost_micros': Type.BIGINT,
+    'start_date': Type.DATE
 }
 
+# Колонки фрейма, которые в целевой таблице вычисляются: колонка фрейма -> (колонка таблицы, тип, выражение)
+_TARGET_EXPRESSIONS = {
+    'cost_micros': ('cost', Type.FLOAT, 'cost_micros / 1000000.0 as cost')
+}
+
+# Типы полей фрейма выгрузки: расход передается целым числом микро-единиц и переводится в валюту в _target_sql
+source_types = {
+    'upd_key': Type.VARCHAR,
+    **_CABINET_FIELDS_TYPES,
+    **{
+        column: _REPORT_COLUMN_TYPES.get(column, _KIND_TYPES[kind])
+        for _report in REPORTS.values() for column, _, kind in _report['fields']
+    }
+}
+
+
+def _target_fields(types) -> tuple:
+    """
+    Функция строит типы полей и запрос целевой таблицы по типам полей фрейма выгрузки
+    @param types: Типы полей фрейма выгрузки
+    @type types: dict
+    @return: Словарь типов полей целевой таблицы и текст запроса
+    @rtype: tuple
+    """
+    target_types = {}
+    select = []
+    for column, field_type in types.items():
+        target_column, target_type, expression = _TARGET_EXPRESSIONS.get(column, (column, field_type, column))
+        target_types[target_column] = target_type
+        select.append(expression)
+    return target_types, "\nselect\n    " + ",\n    ".join(select) + "\nfrom [[ads]]\n;"
+
+
+# Переход с ключа хранилища md5(...) на ключ выгрузки (row_keys.py): ключи строк окна выгрузки меняются,
+# поэтому перед первым запуском с новым ключом строки окна со старым ключом удаляются из целевой таблицы,
+# а первый запуск без индекса отправляет окно целиком уже с новыми ключами:
+#   delete from <целевая таблица>
+#   where date >= current_date - 3
+#     and upd_key = md5(account_id+cabinet_id+date::varchar+campaign_id+ad_group_id+ad_id);
+fields_types, _target_sql = _target_fields(source_types)
+
+# Схема фрейма кабинета: идентификаторы - целые, строки с небольшим числом значений - категории
+_FRAME_SCHEMA = schema_from_fields(
+    source_types,
+    kinds={
+        'account_id': 'int64',
+        'cabinet_id': 'int64',
+        'campaign_id': 'int64',
+        'ad_group_id': 'int64',
+        'ad_id': 'int64',
+        'currency_code': 'category',
+        'time_zone': 'category',
+        'campaign_status': 'category',
+        'ad_group_status': 'category',
+        'ad_type': 'category',
+        'ad_network_type': 'category',
+        'device': 'category',
+    },
+    exclude=('upd_key',)
+)
+
 tpl = EntityBuilderTemplate(
     User.Efremov,
     is_incremental=True,
@@ -550,7 +281,10 @@ tpl = EntityBuilderTemplate(
 tpl.add_stage(Stage([
     FetchListSourceOperator(name='ads',
                             python_callable=main,
-                            types=fields_types
+                            types=source_types
                             )
 ]))
 dag = tpl.DAG()
+# Индекс строк становится действующим только после успешной загрузки (см. row_keys.py)
+dag.on_success_callback = confirm_callback('google_ads')
+dag.max_active_runs = 1
@@ -0,0 +1,372 @@
+""" Источники рекламной статистики с общей схемой и движок их параллельного запуска
+Источник умеет получить список аккаунтов, список сущностей аккаунта и статистику за период.
+Статистика всех источников приводится к одной схеме AD_STATS_SCHEMA: день x кампания x объявление,
+расход в валюте аккаунта (float64), идентификаторы int64.
+"""
+
+import abc
+import time
+import logging
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+import instrumentation
+import vk_ads
+import google_ads
+
+
+# Общая схема статистики: колонка -> тип pandas
+AD_STATS_SCHEMA = {
+    'source': 'str',
+    'date': 'str',
+    'account_id': 'int64',
+    'account_name': 'str',
+    'currency_code': 'str',
+    'campaign_id': 'int64',
+    'campaign_name': 'str',
+    'ad_id': 'int64',
+    'ad_name': 'str',
+    'cost': 'float64',
+    'impressions': 'int64',
+    'clicks': 'int64',
+}
+# Разрез статистики, он же ключ инкремента
+AD_STATS_KEY_COLUMNS = ['source', 'account_id', 'date', 'campaign_id', 'ad_id']
+_METRIC_COLUMNS = ['cost', 'impressions', 'clicks']
+
+
+class RateLimiter:
+    """
+    Ограничение частоты запросов по алгоритму token bucket
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        @param rate: Запросов в секунду, 0 - без ограничения
+        @type rate: float
+        @param burst: Максимальное число запросов подряд, по умолчанию max(rate, 1)
+        @type burst: float
+        """
+        self.rate = rate
+        self.capacity = burst or max(rate, 1)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1) -> None:
+        """
+        Ожидание, пока можно сделать tokens запросов
+        """
+        if not self.rate:
+            return
+        tokens = min(tokens, self.capacity)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            instrumentation.incr('rate_limit_waits')
+            time.sleep(wait)
+
+
+class AdSource(abc.ABC):
+    """
+    Базовый класс источника рекламной статистики
+    """
+    name = None
+    default_rate_limit = 0
+
+    def __init__(self, rate_limit=None):
+        """
+        @param rate_limit: Запросов к API в секунду, по умолчанию default_rate_limit источника
+        @type rate_limit: float
+        """
+        self.limiter = RateLimiter(self.default_rate_limit if rate_limit is None else rate_limit)
+
+    def call(self, func, *args, tokens=1, **kwargs):
+        """
+        Вызов метода API с учетом ограничения частоты источника
+        @param tokens: Сколько запросов к API делает вызов
+        @type tokens: int
+        """
+        self.limiter.acquire(tokens)
+        return func(*args, **kwargs)
+
+    def is_permanent_error(self, error) -> bool:
+        """
+        Ошибка, которая не исправится повторным запуском (аккаунт отключен, нет доступа).
+        Аккаунт с такой ошибкой пропускается, а не останавливает выгрузку
+        @param error: Исключение fetch_stats
+        @type error: Exception
+        @rtype: bool
+        """
+        return False
+
+    def partition_key(self, account) -> str:
+        """
+        Ключ партиции аккаунта, уникальный в пределах источника
+        @param account: Аккаунт из list_accounts
+        @type account: dict
+        @rtype: str
+        """
+        return str(account['account_id'])
+
+    @abc.abstractmethod
+    def list_accounts(self) -> list:
+        """
+        @return: Список аккаунтов - словарей с ключами account_id, account_name, currency_code
+         и служебными полями источника
+        @rtype: list
+        """
+
+    @abc.abstractmethod
+    def list_entities(self, account) -> pd.DataFrame:
+        """
+        Справочник сущностей аккаунта для сверки названий. run_sources его не вызывает:
+        названия кампаний и объявлений приходят вместе со статистикой
+        @param account: Аккаунт из list_accounts
+        @type account: dict
+        @return: Кампании и объявления аккаунта: campaign_id, campaign_name, ad_id, ad_name
+        @rtype: pd.DataFrame
+        """
+
+    @abc.abstractmethod
+    def fetch_stats(self, account, date_from, date_to) -> pd.DataFrame:
+        """
+        @param account: Аккаунт из list_accounts
+        @type account: dict
+        @param date_from: Дата начала в формате 'YYYY-MM-DD'
+        @type date_from: str
+        @param date_to: Дата окончания в формате 'YYYY-MM-DD'
+        @type date_to: str
+        @return: Статистика с колонками date, campaign_id, campaign_name, ad_id, ad_name, cost,
+         impressions, clicks или None, если статистики нет
+        @rtype: pd.DataFrame
+        """
+
+
+class VkAdSource(AdSource):
+    """
+    Статистика VK по клиентам рекламных кабинетов (vk_ads.py)
+    """
+    name = 'vk'
+    default_rate_limit = 2
+
+    def list_accounts(self) -> list:
+        accounts = []
+        for id_rk in vk_ads.IDS_RK:
+            for client in self.call(vk_ads.get_rk_list, vk_ads.TOKEN, id_rk):
+                accounts.append({
+                    'account_id': client['id'],
+                    'account_name': client['name'],
+                    # ads.getClients не возвращает валюту, расход приходит в валюте кабинета
+                    'currency_code': '',
+                    'cabinet_id': id_rk,
+                    'client': client,
+                })
+        return accounts
+
+    def partition_key(self, account) -> str:
+        return f"{account['cabinet_id']}_{account['account_id']}"
+
+    def is_permanent_error(self, error) -> bool:
+        return isinstance(error, vk_ads.PermissionDenied)
+
+    def list_entities(self, account) -> pd.DataFrame:
+        ads = self.call(vk_ads.getAdsData, vk_ads.TOKEN, account['cabinet_id'], account['account_id'])
+        campaigns = self.call(vk_ads.getCampaigns, vk_ads.TOKEN, account['cabinet_id'], account['account_id'])
+        ads = pd.DataFrame(ads, columns=['id', 'name', 'campaign_id']).rename(
+            columns={'id': 'ad_id', 'name': 'ad_name'})
+        campaigns = pd.DataFrame(campaigns, columns=['id', 'name']).rename(
+            columns={'id': 'campaign_id', 'name': 'campaign_name'})
+        return ads.merge(campaigns, on='campaign_id', how='left')
+
+    def fetch_stats(self, account, date_from, date_to) -> pd.DataFrame:
+        df = vk_ads.get_client_data(account['cabinet_id'], account['client'], date_from, date_to, call=self.call)
+        if df is None:
+            return None
+        return df.rename(columns={'day': 'date'}).assign(cost=df['spent_micros'] / 1000000)
+
+
+class GoogleAdSource(AdSource):
+    """
+    Статистика Google Ads по кабинетам (google_ads.py)
+    """
+    name = 'google'
+    default_rate_limit = 10
+    # Только действующие объявления, удаленные не нужны для сверки названий
+    _ENTITIES_QUERY = """
+        SELECT campaign.id, campaign.name, ad_group_ad.ad.id, ad_group_ad.ad.name
+        FROM ad_group_ad
+        WHERE ad_group_ad.status != 'REMOVED'
+          AND campaign.status != 'REMOVED'"""
+
+    def __init__(self, get_creeds, rate_limit=None):
+        """
+        @param get_creeds: Функция get_creeds(login_customer_id=None), возвращающая креды для create_client
+        @type get_creeds: callable
+        @param rate_limit: Запросов к API в секунду, по умолчанию default_rate_limit источника
+        @type rate_limit: float
+        """
+        super().__init__(rate_limit)
+        self.get_creeds = get_creeds
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def _client(self, manager_id=None):
+        with self._lock:
+            if manager_id not in self._clients:
+                self._clients[manager_id] = google_ads.create_client(self.get_creeds(login_customer_id=manager_id))
+            return self._clients[manager_id]
+
+    def list_accounts(self) -> list:
+        hierarchy, updated_at = google_ads.load_account_cache()
+        if hierarchy is None or datetime.now() - updated_at > google_ads.HIERARCHY_CACHE_TTL:
+            hierarchy = self.call(google_ads.refresh_account_cache, self._client())
+        return [
+            {
+                'account_id': cabinet['id'],
+                'account_name': cabinet['name'],
+                'currency_code': cabinet['currency_code'],
+                'manager_id': account['client_id'],
+            }
+            for account in hierarchy for cabinet in account['customers_client']
+        ]
+
+    def list_entities(self, account) -> pd.DataFrame:
+        googleads_service = self._client(account['manager_id']).get_service("GoogleAdsService")
+        rows = self.call(googleads_service.search, customer_id=str(account['account_id']),
+                         query=self._ENTITIES_QUERY)
+        return pd.DataFrame(
+            [(row.campaign.id, row.campaign.name, row.ad_group_ad.ad.id, row.ad_group_ad.ad.name) for row in rows],
+            columns=['campaign_id', 'campaign_name', 'ad_id', 'ad_name']
+        )
+
+    def is_permanent_error(self, error) -> bool:
+        return google_ads.is_permanent_error(error)
+
+    def fetch_stats(self, account, date_from, date_to) -> pd.DataFrame:
+        client = self._client(account['manager_id'])
+        reports = tuple(google_ads.REPORTS)
+        df = self.call(google_ads.get_cabinet_data, client, str(account['account_id']), date_from, date_to,
+                       reports=reports, tokens=len(reports))
+        if df is None:
+            return None
+        # Google Ads не отдает название объявления в отчетах, для Performance Max ad_id = 0
+        return df.rename(columns={'start_date': 'date'}).assign(ad_name='', cost=df['cost_micros'] / 1000000)
+
+
+def normalize_stats(df, source, account) -> pd.DataFrame:
+    """
+    Приведение статистики источника к общей схеме AD_STATS_SCHEMA с суммированием до разреза
+    день x кампания x объявление
+    @param df: Статистика из fetch_stats
+    @type df: pd.DataFrame
+    @param source: Название источника
+    @type source: str
+    @param account: Аккаунт из list_accounts
+    @type account: dict
+    @rtype: pd.DataFrame
+    """
+    df = df.assign(
+        source=source,
+        account_id=account['account_id'],
+        account_name=account['account_name'],
+        currency_code=account['currency_code'],
+    )
+    dimensions = [column for column in AD_STATS_SCHEMA if column not in _METRIC_COLUMNS]
+    for column in _METRIC_COLUMNS:
+        df[column] = pd.to_numeric(df[column], errors='coerce').fillna(0)
+    for column in dimensions:
+        if AD_STATS_SCHEMA[column] == 'int64':
+            df[column] = pd.to_numeric(df[column], errors='coerce').fillna(0).astype('int64')
+        else:
+            df[column] = df[column].fillna('').astype(str)
+    df = df.groupby(dimensions, as_index=False, sort=False)[_METRIC_COLUMNS].sum()
+    return df.astype(AD_STATS_SCHEMA)[list(AD_STATS_SCHEMA)]
+
+
+def _run_source(source, date_from, date_to, sink, row_index) -> int:
+    """
+    Выгрузка всех аккаунтов одного источника в sink, уже записанные партиции пропускаются.
+    Партиция аккаунта, статистику которого не удалось получить, не записывается, после обхода
+    всех аккаунтов пробрасывается ошибка со списком упавших. Аккаунты с постоянной ошибкой
+    (AdSource.is_permanent_error) пропускаются
+    @return: Число записанных строк
+    @rtype: int
+    """
+    rows = 0
+    failed = []
+    with instrumentation.span(f'{source.name}.list_accounts'):
+        accounts = source.list_accounts()
+    for account in accounts:
+        key = f"{source.name}_{source.partition_key(account)}_{date_from}_{date_to}"
+        if sink.is_written(key):
+            logging.info(f"Skip {source.name} account {account['account_id']}, already written")
+            continue
+        logging.info(f"Start {source.name} account {account['account_id']}")
+        try:
+            df = source.fetch_stats(account, date_from, date_to)
+        except Exception as e:
+            if source.is_permanent_error(e):
+                logging.warning(f"{source.name} account {account['account_id']} is not available, skipped\n{e}")
+                instrumentation.incr('skipped_accounts')
+                continue
+            logging.error(f"{source.name} account {account['account_id']} failed, partition is not written\n{e}")
+            failed.append(key)
+            continue
+        if df is not None and not df.empty:
+            with instrumentation.span(f'{source.name}.normalize'):
+                df = normalize_stats(df, source.name, account)
+            if row_index is not None:
+                df = row_index.filter_changed(df)
+        sink.write(key, df)
+        if df is not None:
+            rows += df.shape[0]
+    instrumentation.incr('rows', rows)
+    if failed:
+        raise Exception(f"Partitions failed: {', '.join(failed)}")
+    return rows
+
+
+def run_sources(sources, date_from, date_to, sink, row_index=None) -> dict:
+    """
+    Параллельный запуск источников с записью статистики в один sink.
+    Каждый источник работает в своем потоке со своим ограничением частоты запросов
+    @param sources: Источники
+    @type sources: list
+    @param date_from: Дата начала в формате 'YYYY-MM-DD'
+    @type date_from: str
+    @param date_to: Дата окончания в формате 'YYYY-MM-DD'
+    @type date_to: str
+    @param sink: Хранилище партиций
+    @type sink: BatchSink
+    @param row_index: Индекс строк прошлых запусков, если задан - пишутся только новые и изменившиеся строки
+    @type row_index: RowIndex
+    @return: Число записанных строк по источникам
+    @rtype: dict
+    """
+    with ThreadPoolExecutor(max_workers=len(sources)) as executor:
+        futures = {
+            source.name: instrumentation.submit(executor, _run_source, source, date_from, date_to, sink, row_index)
+            for source in sources
+        }
+    rows, failed = {}, {}
+    for name, future in futures.items():
+        try:
+            rows[name] = future.result()
+        except Exception as e:
+            logging.error(f"Source {name} failed\n{e}")
+            failed[name] = e
+    logging.info(f"Rows by source {rows}")
+    # Партиции успешных источников уже записаны, повторный запуск догрузит только упавшие
+    if failed:
+        raise Exception(f"Sources failed: {', '.join(failed)}")
+    return rows
@@ -0,0 +1,106 @@
+""" Запись результатов выгрузки пачками в локальные Parquet-файлы
+Каждая пачка (кабинет/день) пишется отдельной партицией, поэтому в памяти держится только одна пачка,
+а упавший запуск при повторе пропускает уже записанные партиции
+"""
+
+import os
+import shutil
+import logging
+from datetime import date
+
+import pandas as pd
+
+
+# Каталог локального состояния выгрузок, можно переопределить переменной окружения
+_SPILL_DIR = os.environ.get('ANALYTICS_EXPORT_DIR', '/tmp/analytics_export')
+_EMPTY_SUFFIX = '.empty'
+_PARQUET_SUFFIX = '.parquet'
+
+
+class BatchSink:
+    """
+    Хранилище партиций одного запуска выгрузки: {base_dir}/{name}/{run_id}/{key}.parquet
+    """
+
+    def __init__(self, name, run_id=None, base_dir=_SPILL_DIR):
+        """
+        @param name: Название выгрузки, например 'vk_ads'
+        @type name: str
+        @param run_id: Идентификатор запуска, по умолчанию текущая дата. Повторный запуск
+         с тем же идентификатором продолжает ранее начатый
+        @type run_id: str
+        @param base_dir: Каталог для партиций
+        @type base_dir: str
+        """
+        self.name = name
+        self.run_id = run_id or date.today().isoformat()
+        self.export_dir = os.path.join(base_dir, name)
+        self.run_dir = os.path.join(self.export_dir, self.run_id)
+        os.makedirs(self.run_dir, exist_ok=True)
+
+    def _path(self, key, suffix) -> str:
+        return os.path.join(self.run_dir, f"{key}{suffix}")
+
+    def is_written(self, key) -> bool:
+        """
+        Проверка, что партиция уже записана (в том числе как пустая)
+        @param key: Ключ партиции
+        @type key: str
+        @rtype: bool
+        """
+        return os.path.exists(self._path(key, _PARQUET_SUFFIX)) or os.path.exists(self._path(key, _EMPTY_SUFFIX))
+
+    def write(self, key, df) -> None:
+        """
+        Запись партиции. Файл пишется во временный и переименовывается,
+        поэтому недописанная партиция не считается записанной
+        @param key: Ключ партиции
+        @type key: str
+        @param df: Данные партиции, None или пустой фрейм записывается как пустая партиция
+        @type df: pd.DataFrame
+        """
+        if df is None or df.empty:
+            open(self._path(key, _EMPTY_SUFFIX), 'w').close()
+            return
+        path = self._path(key, _PARQUET_SUFFIX)
+        tmp_path = f"{path}.tmp"
+        df.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, path)
+        logging.info(f"Written partition {key} of {self.name}: {df.shape[0]} rows")
+
+    def keys(self) -> list:
+        """
+        @return: Отсортированный список ключей непустых партиций
+        @rtype: list
+        """
+        return sorted(
+            file_name[:-len(_PARQUET_SUFFIX)] for file_name in os.listdir(self.run_dir)
+            if file_name.endswith(_PARQUET_SUFFIX)
+        )
+
+    def iter_batches(self, cleanup=True):
+        """
+        Генератор партиций запуска по одной
+        @param cleanup: Удалить партиции запуска после того, как прочитаны все
+        @type cleanup: bool
+        @return: Генератор pd.DataFrame
+        """
+        for key in self.keys():
+            yield pd.read_parquet(self._path(key, _PARQUET_SUFFIX))
+        if cleanup:
+            self.cleanup()
+
+    def cleanup(self) -> None:
+        """
+        Удаление партиций текущего запуска
+        """
+        shutil.rmtree(self.run_dir, ignore_errors=True)
+
+    def purge_stale_runs(self) -> None:
+        """
+        Удаление партиций прошлых незавершенных запусков этой выгрузки
+        """
+        for run_id in os.listdir(self.export_dir):
+            if run_id != self.run_id:
+                logging.info(f"Removing stale run {run_id} of {self.name}")
+                shutil.rmtree(os.path.join(self.export_dir, run_id), ignore_errors=True)
@@ -0,0 +1,130 @@
+""" Замер производительности выгрузок на записанных ответах API (см. replay.py)
+Каждая выгрузка запускается в отдельном процессе с чистым локальным состоянием, результат -
+строки в секунду, число запросов к API, пиковый RSS и время выполнения main().
+
+    python benchmark.py --vk-fixtures fixtures/vk.json --google-fixtures fixtures/google.json --latency 0.05
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import subprocess
+
+import replay
+import instrumentation
+
+
+_EXPORTERS = ('vk', 'google')
+
+
+def _peak_rss_mb() -> float:
+    # ru_maxrss в Linux - в килобайтах
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_exporter(exporter, fixtures_path, latency=0.0, rate_limit=0, sleep_scale=0.0) -> dict:
+    """
+    Прогон main() одной выгрузки на записанных ответах в текущем процессе
+    @param exporter: 'vk' или 'google'
+    @type exporter: str
+    @param fixtures_path: Файл с записанными ответами
+    @type fixtures_path: str
+    @param latency: Задержка ответа API в секундах
+    @type latency: float
+    @param rate_limit: Максимум запросов к API в секунду, 0 - без ограничения
+    @type rate_limit: int
+    @param sleep_scale: Множитель пауз внутри выгрузки (между чанками, перед повтором запроса)
+    @type sleep_scale: float
+    @return: Метрики прогона
+    @rtype: dict
+    """
+    os.environ.setdefault('ANALYTICS_EXPORT_DIR', tempfile.mkdtemp())
+    os.environ.setdefault('ANALYTICS_INDEX_DIR', os.path.join(os.environ['ANALYTICS_EXPORT_DIR'], 'index'))
+    if exporter == 'vk':
+        server = replay.FakeVkServer(fixtures_path, latency=latency, rate_limit=rate_limit).start()
+        os.environ['VK_API_URL'] = server.url
+        stats = server.stats
+        module = replay.load_exporter(replay.VK_EXPORTER, sleep_scale=sleep_scale)
+    else:
+        replay.install_fake_google_ads()
+        replay.FakeGoogleAdsClient.configure(fixtures_path, latency=latency, rate_limit=rate_limit)
+        stats = replay.FakeGoogleAdsClient.stats
+        module = replay.load_exporter(replay.GOOGLE_EXPORTER, sleep_scale=sleep_scale)
+
+    # Замеры этапов включены всегда, чтобы в результате было видно, на что ушло время
+    instrumentation.configure(enabled=True, trace_path=os.environ.get('EXPORT_TRACE_FILE'))
+    started = time.perf_counter()
+    rows = 0
+    for batch in module['main']():
+        rows += batch.shape[0]
+    wall_time = time.perf_counter() - started
+
+    if exporter == 'vk':
+        server.stop()
+    summary = instrumentation.run_summary(exporter)
+    return {
+        'exporter': exporter,
+        'rows': rows,
+        'wall_time_s': round(wall_time, 3),
+        'rows_per_s': round(rows / wall_time, 1) if wall_time else None,
+        'peak_rss_mb': round(_peak_rss_mb(), 1),
+        **stats.as_dict(),
+        'counters': summary['counters'],
+        'stages': summary['stages'],
+    }
+
+
+def run_isolated(exporter, fixtures_path, latency=0.0, rate_limit=0, sleep_scale=0.0) -> dict:
+    """
+    Прогон выгрузки в отдельном процессе с отдельным каталогом состояния,
+    чтобы пиковый RSS и индексы прошлых прогонов не влияли на результат
+    """
+    with tempfile.TemporaryDirectory() as state_dir:
+        env = {**os.environ, 'ANALYTICS_EXPORT_DIR': state_dir,
+               'ANALYTICS_INDEX_DIR': os.path.join(state_dir, 'index')}
+        command = [sys.executable, os.path.abspath(__file__), '--child', exporter,
+                   '--fixtures', fixtures_path, '--latency', str(latency),
+                   '--rate-limit', str(rate_limit), '--sleep-scale', str(sleep_scale)]
+        output = subprocess.run(command, env=env, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(argv=None) -> list:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--vk-fixtures')
+    parser.add_argument('--google-fixtures')
+    parser.add_argument('--latency', type=float, default=0.0, help='Задержка ответа API, секунды')
+    parser.add_argument('--rate-limit', type=int, default=0, help='Запросов в секунду, 0 - без ограничения')
+    parser.add_argument('--sleep-scale', type=float, default=0.0, help='Множитель пауз внутри выгрузки')
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--output', help='Файл для JSON с результатами')
+    parser.add_argument('--child', choices=_EXPORTERS, help=argparse.SUPPRESS)
+    parser.add_argument('--fixtures', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        result = run_exporter(args.child, args.fixtures, args.latency, args.rate_limit, args.sleep_scale)
+        print(json.dumps(result))
+        return [result]
+
+    results = []
+    for exporter, fixtures_path in (('vk', args.vk_fixtures), ('google', args.google_fixtures)):
+        if not fixtures_path:
+            continue
+        for _ in range(args.repeat):
+            result = run_isolated(exporter, os.path.abspath(fixtures_path),
+                                  args.latency, args.rate_limit, args.sleep_scale)
+            results.append(result)
+            print(json.dumps(result))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+""" Приведение фреймов выгрузок к схеме за один проход по колонкам
+Схема строится из словарей типов полей выгрузки (fields_types / types) и задает для каждой колонки вид значения:
+    'int64', 'float64' - числа, значения, которые не удалось привести, заменяются на 0 и попадают в отчет об ошибках
+    'micros' - деньги в единицах валюты, хранятся целым числом микро-единиц (1.5 -> 1500000)
+    'category' - строки с небольшим числом значений (статусы, устройства, типы сети)
+    'str' - строки
+    'date' - дата в формате 'YYYY-MM-DD', значения, которые не удалось привести, заменяются на '' и попадают
+        в отчет об ошибках
+Тип поля, которого нет в _TYPE_KINDS, - ошибка: вид такой колонки задается явно через kinds
+"""
+
+import logging
+
+import numpy as np
+import pandas as pd
+
+import instrumentation
+
+
+_TYPE_KINDS = {
+    'BIGINT': 'int64',
+    'BIG_INTEGER': 'int64',
+    'INTEGER': 'int64',
+    'INT': 'int64',
+    'SMALLINT': 'int64',
+    'SMALL_INTEGER': 'int64',
+    'FLOAT': 'float64',
+    'DOUBLE': 'float64',
+    'REAL': 'float64',
+    'NUMERIC': 'float64',
+    'DECIMAL': 'float64',
+    'DATE': 'date',
+    'VARCHAR': 'str',
+    'STRING': 'str',
+    'TEXT': 'str',
+    'CHAR': 'str',
+}
+_MICROS = 1000000
+
+
+def _type_name(field_type) -> str:
+    """
+    Имя типа поля без параметров и префикса: Type.VARCHAR, Type.VARCHAR(32768), 'VARCHAR' и значение
+    перечисления, которое выводится как 'Type.VARCHAR', дают 'VARCHAR'
+    """
+    for attribute in ('__visit_name__', 'name', '__name__'):
+        name = getattr(field_type, attribute, None)
+        if isinstance(name, str) and name:
+            break
+    else:
+        name = str(field_type)
+    return name.split('(')[0].rsplit('.', 1)[-1].strip().upper()
+
+
+def schema_from_fields(fields_types, kinds=None, exclude=()) -> dict:
+    """
+    Схема фрейма из словаря типов полей выгрузки
+    @param fields_types: Словарь колонка -> Type
+    @type fields_types: dict
+    @param kinds: Явно заданные виды колонок, например {'cost_micros': 'int64', 'device': 'category'}
+    @type kinds: dict
+    @param exclude: Колонки, которые не приводятся (например ключ инкремента)
+    @type exclude: tuple
+    @return: Словарь колонка -> вид значения
+    @rtype: dict
+    @raise ValueError: Тип поля не известен и вид колонки не задан в kinds
+    """
+    kinds = kinds or {}
+    schema = {}
+    for column, field_type in fields_types.items():
+        if column in exclude:
+            continue
+        if kinds.get(column):
+            schema[column] = kinds[column]
+            continue
+        type_name = _type_name(field_type)
+        if type_name not in _TYPE_KINDS:
+            raise ValueError(f"{column}: unknown field type {field_type!r} ({type_name}), set its kind in kinds")
+        schema[column] = _TYPE_KINDS[type_name]
+    for column, kind in kinds.items():
+        schema.setdefault(column, kind)
+    return schema
+
+
+def _failed(errors, column, values, mask) -> None:
+    if mask.any():
+        errors.append(pd.DataFrame({'row': np.flatnonzero(mask), 'column': column, 'value': values[mask].astype(str)}))
+
+
+def _cast_column(values, kind, column, errors) -> pd.Series:
+    if kind in ('int64', 'float64', 'micros'):
+        numbers = pd.to_numeric(values, errors='coerce')
+        _failed(errors, column, values.to_numpy(), (numbers.isna() & values.notna() & (values != '')).to_numpy())
+        numbers = numbers.fillna(0)
+        if kind == 'micros':
+            return (numbers * _MICROS).round().astype('int64')
+        if kind == 'int64':
+            # Дробные значения в целой колонке - ошибка схемы, а не повод молча отбросить дробную часть
+            _failed(errors, column, values.to_numpy(), (numbers % 1 != 0).to_numpy())
+            return numbers.round().astype('int64')
+        return numbers.astype('float64')
+    if kind == 'date':
+        dates = pd.to_datetime(values, format='%Y-%m-%d', errors='coerce')
+        _failed(errors, column, values.to_numpy(), (dates.isna() & values.notna() & (values != '')).to_numpy())
+        return dates.dt.strftime('%Y-%m-%d').fillna('').astype(str)
+    strings = values.fillna('').astype(str)
+    if kind == 'category':
+        return strings.astype('category')
+    return strings
+
+
+def cast_frame(df, schema, name='frame') -> tuple:
+    """
+    Приведение фрейма к схеме: недостающие колонки добавляются со значениями по умолчанию,
+    лишние отбрасываются с записью в лог, порядок колонок - как в схеме
+    @param df: Фрейм
+    @type df: pd.DataFrame
+    @param schema: Схема из schema_from_fields
+    @type schema: dict
+    @param name: Название фрейма для лога
+    @type name: str
+    @return: Приведенный фрейм и фрейм ошибок приведения (row, column, value)
+    @rtype: tuple
+    """
+    dropped = [column for column in df.columns if column not in schema]
+    if dropped:
+        logging.info(f"{name}: columns not in schema are dropped {dropped}")
+    errors = []
+    columns = {}
+    for column, kind in schema.items():
+        if column in df.columns:
+            values = df[column].reset_index(drop=True)
+        else:
+            values = pd.Series([None] * len(df), dtype=object)
+        columns[column] = _cast_column(values, kind, column, errors)
+    result = pd.DataFrame(columns)
+    result.index = df.index
+    errors = pd.concat(errors, ignore_index=True) if errors else pd.DataFrame(columns=['row', 'column', 'value'])
+    if not errors.empty:
+        instrumentation.incr('cast_errors', errors.shape[0])
+        logging.warning(f"{name}: {errors.shape[0]} values failed casting, "
+                        f"by column {errors['column'].value_counts().to_dict()}\n{errors.head(10)}")
+    return result, errors
@@ -0,0 +1,494 @@
+""" Получение статистики Google Ads: иерархия аккаунтов и отчеты кабинетов из реестра REPORTS
+Модуль без побочных эффектов при импорте, его используют выгрузка Google Ads API.py и источники ad_sources.py.
+Описание полей можно найти в документации https://developers.google.com/google-ads/api/fields/v9/overview
+"""
+
+import pandas as pd
+import logging
+import json
+import os
+import uuid
+from datetime import datetime, timedelta
+from operator import attrgetter
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from google.ads.googleads.client import GoogleAdsClient
+import instrumentation
+
+
+def creeds_from_connection(conn, login_customer_id=None) -> dict:
+    """
+    Функция возвращает креды для создания клиента из подключения Airflow
+    @param conn: Подключение google_ads_new
+    @type conn: object
+    @param login_customer_id: Идентификатор зависит от аккаунта к которому осуществляются запросы
+    @type login_customer_id: str
+    @return: Словарь кредов
+    @rtype: dict
+    """
+    cred_dict = {
+        'developer_token': conn.extra_dejson.get('developer_token'),
+        'refresh_token': conn.extra_dejson.get('refresh_token'),
+        'client_id': conn.extra_dejson.get('client_id'),
+        'client_secret': conn.extra_dejson.get('client_secret'),
+        'access_token': conn.extra_dejson.get('access_token'),
+        'use_proto_plus': True,
+        'login_customer_id': login_customer_id
+    }
+    return cred_dict
+
+
+def create_client(cred_dict, _version="v9") -> object:
+    """
+    Функция для создания класса клиента, по которому в дальнейшим осуществляется запросы
+    @param cred_dict: Словарь кредов получается функцией get_creeds
+    @type cred_dict: dict
+    @param _version: Версия API
+    @type _version: str
+    @return: Класс для обращений к API
+    @rtype: object
+    """
+    try:
+        client = GoogleAdsClient.load_from_dict(cred_dict, version=_version)
+        return client
+    except Exception as e:
+        logging.error(f"Create client Failed \nPlease check function 'create_client'\n{e}")
+
+
+def _account_hierarchy(customer_client, customer_ids_to_child_accounts) -> dict:
+    """
+    Функция для парсинга иерархии аккаунта
+    @param customer_client: Класс клиента
+    @type customer_client: object
+    @param customer_ids_to_child_accounts: Класс кабинетов клиента
+    @type customer_ids_to_child_accounts: object
+    @return: Словарь клиента со списком всех входящих кабинетов
+    @rtype: dict
+    """
+    # проверка на наличие клиентов у аккаунта
+    if len(customer_ids_to_child_accounts) > 0:
+        dict_customer_client = {
+            'client_id': customer_client.id,
+            'client_name': customer_client.descriptive_name,
+            'customers_client': []
+        }
+        for child_account in customer_ids_to_child_accounts[customer_client.id]:
+            dict_child_account = {
+                'id': child_account.id,
+                'name': child_account.descriptive_name,
+                'currency_code': child_account.currency_code,
+                'time_zone': child_account.time_zone
+            }
+            dict_customer_client['customers_client'].append(dict_child_account)
+    # Если у аккаунта нет клиентов - в качестве клиента возвращаем сам аккаунт
+    else:
+        dict_customer_client = {
+            'client_id': customer_client.id,
+            'client_name': customer_client.descriptive_name,
+            'customers_client': [
+                {
+                    'id': customer_client.id,
+                    'name': customer_client.descriptive_name,
+                    'currency_code': customer_client.currency_code,
+                    'time_zone': customer_client.time_zone
+                }
+            ]
+        }
+    return dict_customer_client
+
+
+# Запрос, который извлекает все дочерние учетные записи менеджера.
+_HIERARCHY_QUERY = """
+    SELECT
+      customer_client.client_customer,
+      customer_client.level,
+      customer_client.manager,
+      customer_client.descriptive_name,
+      customer_client.currency_code,
+      customer_client.time_zone,
+      customer_client.id
+    FROM customer_client
+    WHERE customer_client.level <= 1
+      AND customer_client.status = 'ENABLED'"""
+
+# Кэш иерархии аккаунтов между запусками и время, после которого он считается устаревшим
+_HIERARCHY_CACHE_PATH = os.path.join(os.environ.get('ANALYTICS_EXPORT_DIR', '/tmp/analytics_export'),
+                                     'google_ads_account_hierarchy.json')
+HIERARCHY_CACHE_TTL = timedelta(days=1)
+# Максимум одновременных обходов иерархии, чтобы при десятках менеджеров не упереться в лимиты API
+_HIERARCHY_WORKERS = 8
+
+
+def _get_customer_hierarchy(googleads_service, seed_customer_id) -> dict:
+    """
+    Функция обходит иерархию одного аккаунта в ширину
+    @param googleads_service: Экземпляр GoogleAdsService
+    @type googleads_service: object
+    @param seed_customer_id: Идентификатор аккаунта, с которого начинается обход
+    @type seed_customer_id: str
+    @return: Словарь клиента из _account_hierarchy или None, если иерархию получить нельзя
+    @rtype: dict
+    """
+    unprocessed_customer_ids = deque([int(seed_customer_id)])
+    # Клиентом могут управлять несколько менеджеров, поэтому
+    # чтобы не посещать одного и того же клиента много раз, храним посещенных.
+    visited_customer_ids = {int(seed_customer_id)}
+    customer_ids_to_child_accounts = dict()
+    root_customer_client = None
+
+    while unprocessed_customer_ids:
+        customer_id = unprocessed_customer_ids.popleft()
+        with instrumentation.span('google.customer_client', histogram='http_latency_ms', customer_id=customer_id):
+            response = list(googleads_service.search(
+                customer_id=str(customer_id), query=_HIERARCHY_QUERY
+            ))
+        instrumentation.incr('requests')
+        if instrumentation.enabled():
+            instrumentation.incr('bytes', sum(instrumentation.message_size(row) for row in response))
+
+        # Выполняет итерацию по всем строкам на всех страницах,
+        # чтобы получить все кабинеты клиентов
+        for googleads_row in response:
+            customer_client = googleads_row.customer_client
+
+            # Кабинет клиента, который с уровнем 0 является указанным Кабинет
+            if customer_client.level == 0:
+                if root_customer_client is None:
+                    root_customer_client = customer_client
+                continue
+
+            customer_ids_to_child_accounts.setdefault(customer_id, []).append(
+                customer_client
+            )
+
+            if (
+                    customer_client.manager
+                    and customer_client.level == 1
+                    and customer_client.id not in visited_customer_ids
+            ):
+                visited_customer_ids.add(customer_client.id)
+                unprocessed_customer_ids.append(customer_client.id)
+
+    if root_customer_client is None:
+        logging.info(
+            f"Customer ID {seed_customer_id} is likely a test "
+            "account, so its customer client information cannot be "
+            "retrieved."
+        )
+        return None
+    logging.info(f"Got the hierarchy of customer ID {root_customer_client.id}")
+    return _account_hierarchy(root_customer_client, customer_ids_to_child_accounts)
+
+
+def get_account_list(client, login_customer_id=None) -> list:
+    """
+    Функция для получения иерархии аккаунта. Иерархии аккаунтов запрашиваются параллельно
+    @param client: Клиент к которому осуществляются запросы, получается из create_client
+    @type client: object
+    @param login_customer_id: Идентификатор клиента, если нужно получить по конкретному,
+     если None - возвращает по всем доступным
+    @type login_customer_id: str
+    @return: Список словарей с иерархией аккаунта
+    @rtype: list
+    """
+
+    # Получает экземпляры клиентов GoogleAdsService и CustomerService.
+    googleads_service = client.get_service("GoogleAdsService")
+    customer_service = client.get_service("CustomerService")
+
+    # Лист идентификаторов клиентов для обработки.
+    seed_customer_ids = []
+
+    # Если идентификатор менеджера был указан в параметре customerId, он будет единственным идентификатором в списке.
+    # В противном случае мы отправим запрос для всех клиентов,
+    # доступных для этой аутентифицированной учетной записи Google.
+    if login_customer_id is not None:
+        seed_customer_ids = [login_customer_id]
+    else:
+        logging.info(
+            "No manager ID is specified. Getting the "
+            "hierarchies of all accessible customer IDs."
+        )
+
+        customer_resource_names = (
+            customer_service.list_accessible_customers().resource_names
+        )
+
+        for customer_resource_name in customer_resource_names:
+            customer_id = googleads_service.parse_customer_path(
+                customer_resource_name
+            )["customer_id"]
+            logging.info(customer_id)
+            seed_customer_ids.append(customer_id)
+
+    with ThreadPoolExecutor(max_workers=max(min(_HIERARCHY_WORKERS, len(seed_customer_ids)), 1)) as executor:
+        futures = [
+            instrumentation.submit(executor, _get_customer_hierarchy, googleads_service, seed_customer_id)
+            for seed_customer_id in seed_customer_ids
+        ]
+        hierarchies = [future.result() for future in futures]
+    return [hierarchy for hierarchy in hierarchies if hierarchy is not None]
+
+
+def load_account_cache(path=_HIERARCHY_CACHE_PATH) -> tuple:
+    """
+    Функция читает сохраненную иерархию аккаунтов
+    @param path: Путь к файлу кэша
+    @type path: str
+    @return: Список словарей с иерархией аккаунта и время его обновления, (None, None) если кэша нет
+    @rtype: tuple
+    """
+    try:
+        with open(path) as cache_file:
+            cache = json.load(cache_file)
+        return cache['hierarchy'], datetime.fromisoformat(cache['updated_at'])
+    except (OSError, ValueError, KeyError) as e:
+        logging.info(f"Account hierarchy cache is not available: {e}")
+        return None, None
+
+
+def refresh_account_cache(client, path=_HIERARCHY_CACHE_PATH) -> list:
+    """
+    Функция запрашивает иерархию аккаунтов и сохраняет ее в кэш
+    @param client: Клиент к которому осуществляются запросы, получается из create_client
+    @type client: object
+    @param path: Путь к файлу кэша
+    @type path: str
+    @return: Список словарей с иерархией аккаунта
+    @rtype: list
+    """
+    account_hierarchy = get_account_list(client)
+    cache = {'updated_at': datetime.now().isoformat(), 'hierarchy': account_hierarchy}
+    # Пишем во временный файл и переименовываем, чтобы не оставить кэш недописанным.
+    # Кэш обновляют и выгрузка Google Ads API.py, и сводная Ad stats API.py, поэтому временный файл у каждой записи свой
+    tmp_path = f"{path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, 'w') as cache_file:
+        json.dump(cache, cache_file)
+    os.replace(tmp_path, path)
+    return account_hierarchy
+
+
+# Реестр отчетов. Каждый отчет описывает ресурс GAQL, выбираемые поля, фильтры и схему выходного фрейма.
+# Поле задается кортежем (колонка во фрейме, поле GAQL, тип значения), где тип:
+#   'int', 'float', 'str' - значение берется как есть
+#   'enum' - берется имя значения перечисления (.name)
+#   'list' - повторяющееся поле, склеивается в строку через запятую
+# Деньги остаются в микро-единицах (cost_micros), типы колонок итогового фрейма задает выгрузка.
+# Для добавления новой метрики достаточно добавить поле в нужный отчет: типы полей выгрузки, схема фрейма
+# и колонки целевой таблицы строятся по REPORTS в Google Ads API.py. Тип колонки в хранилище определяется
+# типом значения (_KIND_TYPES), если колонке нужен другой тип - он задается в _REPORT_COLUMN_TYPES.
+# Документация https://developers.google.com/google-ads/api/fields/v9/overview
+_CAMPAIGN_FIELDS = [
+    ('campaign_name', 'campaign.name', 'str'),
+    ('campaign_id', 'campaign.id', 'int'),
+    ('campaign_status', 'campaign.status', 'enum'),
+]
+
+_METRIC_AND_SEGMENT_FIELDS = [
+    ('clicks', 'metrics.clicks', 'int'),
+    ('impressions', 'metrics.impressions', 'int'),
+    ('cost_micros', 'metrics.cost_micros', 'int'),
+    ('all_conversions', 'metrics.all_conversions', 'float'),
+    ('view_through_conversions', 'metrics.view_through_conversions', 'int'),
+    ('start_date', 'segments.date', 'str'),
+    ('ad_network_type', 'segments.ad_network_type', 'enum'),
+    ('device', 'segments.device', 'enum'),
+]
+
+REPORTS = {
+    # Данные в разрезе объявлений
+    'ads': {
+        'resource': 'ad_group_ad',
+        'fields': _CAMPAIGN_FIELDS + [
+            ('ad_group_id', 'ad_group.id', 'int'),
+            ('ad_group_name', 'ad_group.name', 'str'),
+            ('ad_group_status', 'ad_group.status', 'enum'),
+            ('labels', 'ad_group_ad.labels', 'list'),
+            ('ad_id', 'ad_group_ad.ad.id', 'int'),
+            ('ad_type', 'ad_group_ad.ad.type', 'enum'),
+            ('tracking_url_template', 'ad_group_ad.ad.tracking_url_template', 'str'),
+            ('description', 'ad_group_ad.ad.expanded_text_ad.description', 'str'),
+            ('description2', 'ad_group_ad.ad.expanded_text_ad.description2', 'str'),
+            ('display_url', 'ad_group_ad.ad.display_url', 'str'),
+            ('headline_part1', 'ad_group_ad.ad.expanded_text_ad.headline_part1', 'str'),
+            ('headline_part2', 'ad_group_ad.ad.expanded_text_ad.headline_part2', 'str'),
+            ('headline_part3', 'ad_group_ad.ad.expanded_text_ad.headline_part3', 'str'),
+        ] + _METRIC_AND_SEGMENT_FIELDS,
+        'filters': [],
+        'order_by': 'campaign.id',
+    },
+    # Кампании "максимальной эффективности" выгружаются только в разрезе кампаний,
+    # поля групп и объявлений для них не запрашиваются
+    'performance_max': {
+        'resource': 'campaign',
+        'fields': _CAMPAIGN_FIELDS + _METRIC_AND_SEGMENT_FIELDS,
+        'filters': ['campaign.advertising_channel_type = PERFORMANCE_MAX'],
+        'order_by': 'campaign.id',
+    },
+}
+
+# Колонки фрейма кабинета: колонки всех отчетов в порядке объявления
+_REPORT_COLUMNS = list(dict.fromkeys(
+    column for _report in REPORTS.values() for column, _, _ in _report['fields']
+))
+
+
+def build_query(report, start_date, end_date) -> str:
+    """
+    Функция собирает GAQL-запрос по описанию отчета из реестра REPORTS
+    @param report: Название отчета из REPORTS
+    @type report: str
+    @param start_date: Дата начала в формате 'YYYY-MM-DD'
+    @type start_date: str
+    @param end_date: Дата окончания в формате 'YYYY-MM-DD'
+    @type end_date: str
+    @return: Текст запроса
+    @rtype: str
+    """
+    spec = REPORTS[report]
+    conditions = [f"segments.date BETWEEN '{start_date}' AND '{end_date}'"] + spec['filters']
+    query = (
+        "SELECT " + ", ".join(field for _, field, _ in spec['fields'])
+        + " FROM " + spec['resource']
+        + " WHERE " + " AND ".join(conditions)
+    )
+    if spec.get('order_by'):
+        query += " ORDER BY " + spec['order_by']
+    return query
+
+
+def _field_getter(field):
+    """
+    Функция возвращает функцию чтения поля GAQL из строки ответа.
+    В proto-plus поля, совпадающие с именами python (например type), имеют суффикс '_'
+    @param field: Поле GAQL, например 'ad_group_ad.ad.type'
+    @type field: str
+    @return: Функция от строки ответа
+    @rtype: callable
+    """
+    path = [part + '_' if part == 'type' else part for part in field.split('.')]
+    return attrgetter('.'.join(path))
+
+
+def _decode_column(values, kind) -> list:
+    """
+    Функция приводит сырые значения одной колонки к значениям для фрейма
+    @param values: Значения колонки в порядке строк ответа
+    @type values: list
+    @param kind: Тип значения из описания поля
+    @type kind: str
+    @return: Список значений
+    @rtype: list
+    """
+    if kind == 'enum':
+        return [value.name for value in values]
+    if kind == 'list':
+        return [','.join(value) for value in values]
+    return values
+
+
+def get_report_data(client, report, account_id, start_date, end_date) -> pd.DataFrame:
+    """
+    Функция для получения данных отчета из реестра REPORTS по кабинету.
+    Разбираются только поля, выбранные в отчете
+
+    @param client: Объект клиента из функции create_client
+    @type client: object
+    @param report: Название отчета из REPORTS
+    @type report: str
+    @param account_id: Идентификатор РК
+    @type account_id: str
+    @param start_date: Дата начала в формате 'YYYY-MM-DD'
+    @type start_date: str
+    @param end_date: Дата окончания в формате 'YYYY-MM-DD'
+    @type end_date: str
+    @return: Возвращает pd.DataFrame с данными отчета или None, если данных нет.
+     Ошибка запроса пробрасывается, чтобы неполные данные кабинета не были записаны
+    @rtype: pd.DataFrame
+    """
+    spec = REPORTS[report]
+    getters = [(column, _field_getter(field)) for column, field, _ in spec['fields']]
+    ga_service = client.get_service("GoogleAdsService")
+
+    # Получение данных
+    search_request = client.get_type("SearchGoogleAdsStreamRequest")
+    search_request.customer_id = account_id
+    search_request.query = build_query(report, start_date, end_date)
+
+    try:
+        columns = {column: [] for column, _ in getters}
+        # В задержку HTTP попадает только ожидание ответов потока, разбор строк замеряется отдельно
+        stream = instrumentation.timed_iter(ga_service.search_stream(search_request), 'google.search_stream',
+                                            histogram='http_latency_ms', report=report, customer_id=account_id)
+        for batch in stream:
+            if instrumentation.enabled():
+                instrumentation.incr('bytes', instrumentation.message_size(batch))
+            with instrumentation.span('google.extract', report=report):
+                for row in batch.results:
+                    for column, getter in getters:
+                        columns[column].append(getter(row))
+        instrumentation.incr('requests')
+        if not columns[getters[0][0]]:
+            return None
+
+        with instrumentation.span('google.decode', report=report):
+            data_df = pd.DataFrame({
+                column: _decode_column(columns[column], kind) for column, _, kind in spec['fields']
+            })
+        return data_df
+    except Exception as e:
+        instrumentation.incr('errors')
+        logging.error(f"Report {report} for {account_id} failed\n{e}")
+        raise
+
+
+@instrumentation.timed('google.cabinet')
+def get_cabinet_data(client, account_id, start_date, end_date, reports=tuple(REPORTS)) -> pd.DataFrame:
+    """
+    Функция для получения данных по кабинету по всем отчетам.
+    Отчеты запрашиваются параллельно через одного клиента
+
+    @param client: Объект клиента из функции create_client
+    @type client: object
+    @param account_id: Идентификатор РК
+    @type account_id: str
+    @param start_date: Дата начала в формате 'YYYY-MM-DD'
+    @type start_date: str
+    @param end_date: Дата окончания в формате 'YYYY-MM-DD'
+    @type end_date: str
+    @param reports: Названия отчетов из REPORTS
+    @type reports: tuple
+    @return: Возвращает pd.DataFrame с колонками _REPORT_COLUMNS или None, если данных нет.
+     Колонки, которых нет в отчете, пустые - типы приводит выгрузка (cast_frame).
+     Если хотя бы один отчет не получен, пробрасывается его ошибка
+    @rtype: pd.DataFrame
+    """
+    with ThreadPoolExecutor(max_workers=len(reports)) as executor:
+        futures = [
+            instrumentation.submit(executor, get_report_data, client, report, account_id, start_date, end_date)
+            for report in reports
+        ]
+        frames = [future.result() for future in futures]
+    frames = [frame for frame in frames if frame is not None]
+    if not frames:
+        return None
+
+    return pd.concat(frames, ignore_index=True).reindex(columns=_REPORT_COLUMNS)
+
+
+# Коды ошибок Google Ads, которые не исправятся повторным запуском: кабинет отключен или удален, доступ отозван
+_PERMANENT_ERRORS = ('CUSTOMER_NOT_ENABLED', 'CUSTOMER_NOT_FOUND', 'USER_PERMISSION_DENIED', 'INVALID_CUSTOMER_ID')
+
+
+def is_permanent_error(error) -> bool:
+    """
+    Функция проверяет, что ошибка запроса к кабинету постоянная. Кабинет с такой ошибкой пропускается,
+    а не останавливает выгрузку
+    @param error: Исключение запроса, обычно GoogleAdsException
+    @type error: Exception
+    @rtype: bool
+    """
+    failure = getattr(error, 'failure', None)
+    codes = [str(item.error_code) for item in failure.errors] if failure is not None else []
+    codes.append(str(error))
+    return any(name in code for code in codes for name in _PERMANENT_ERRORS)
@@ -0,0 +1,316 @@
+""" Замеры этапов выгрузки: время запросов к API и преобразований, счетчики запросов, повторов, строк и байт,
+гистограммы задержек HTTP. По окончании запуска пишется JSON-сводка, а при заданном файле трассировки -
+спаны в формате OTLP/JSON: строка файла - запрос ExportTraceServiceRequest (resourceSpans / scopeSpans / spans)
+со спанами запуска, как у файлового экспортера OpenTelemetry Collector.
+
+Включается переменными окружения:
+    EXPORT_INSTRUMENTATION=1 - сбор замеров и сводка
+    EXPORT_TRACE_FILE=/path/spans.jsonl - дополнительно запись спанов
+Выключенные замеры сводятся к одной проверке флага.
+"""
+
+import os
+import json
+import time
+import uuid
+import bisect
+import logging
+import threading
+import contextvars
+from functools import wraps
+
+
+# Границы корзин гистограммы задержек, миллисекунды
+_LATENCY_BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+# Значения перечислений OTLP: в OTLP/JSON перечисления кодируются числами
+_SPAN_KIND_INTERNAL = 1
+_STATUS_CODE_OK = 1
+_STATUS_CODE_ERROR = 2
+_SCOPE_NAME = 'analytics_export'
+_END = object()
+
+
+class _State:
+    def __init__(self):
+        self.enabled = os.environ.get('EXPORT_INSTRUMENTATION', '') not in ('', '0')
+        self.trace_path = os.environ.get('EXPORT_TRACE_FILE')
+        if self.trace_path:
+            self.enabled = True
+        self.reset()
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.trace_id = uuid.uuid4().hex
+        self.started = time.time()
+        self.counters = {}
+        self.stages = {}
+        self.histograms = {}
+        self.spans = []
+
+
+_state = _State()
+_current_span = contextvars.ContextVar('current_span', default=None)
+
+
+def configure(enabled=True, trace_path=None) -> None:
+    """
+    Включение замеров из кода и сброс накопленных значений
+    @param enabled: Собирать замеры
+    @type enabled: bool
+    @param trace_path: Файл для записи спанов
+    @type trace_path: str
+    """
+    _state.enabled = enabled
+    _state.trace_path = trace_path
+    _state.reset()
+
+
+def enabled() -> bool:
+    return _state.enabled
+
+
+def incr(counter, value=1) -> None:
+    """
+    Увеличение счетчика, например requests, retries, rows, bytes
+    """
+    if not _state.enabled:
+        return
+    with _state.lock:
+        _state.counters[counter] = _state.counters.get(counter, 0) + value
+
+
+def observe(histogram, value_ms) -> None:
+    """
+    Добавление значения в гистограмму задержек
+    @param histogram: Название гистограммы
+    @type histogram: str
+    @param value_ms: Значение в миллисекундах
+    @type value_ms: float
+    """
+    if not _state.enabled:
+        return
+    with _state.lock:
+        data = _state.histograms.get(histogram)
+        if data is None:
+            data = _state.histograms[histogram] = {
+                'count': 0, 'sum_ms': 0.0, 'buckets': [0] * (len(_LATENCY_BUCKETS_MS) + 1)
+            }
+        data['count'] += 1
+        data['sum_ms'] += value_ms
+        data['buckets'][bisect.bisect_left(_LATENCY_BUCKETS_MS, value_ms)] += 1
+
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set_attribute(self, key, value):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class _Span:
+    def __init__(self, name, histogram, attributes):
+        self.name = name
+        self.histogram = histogram
+        self.attributes = attributes
+        self.span_id = uuid.uuid4().hex[:16]
+
+    def set_attribute(self, key, value) -> None:
+        self.attributes[key] = value
+
+    def __enter__(self):
+        parent = _current_span.get()
+        self.parent_id = parent.span_id if parent is not None else None
+        self._token = _current_span.set(self)
+        self.start_ns = time.time_ns()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration_ms = (time.perf_counter() - self._start) * 1000
+        end_ns = time.time_ns()
+        _current_span.reset(self._token)
+        with _state.lock:
+            stage = _state.stages.get(self.name)
+            if stage is None:
+                stage = _state.stages[self.name] = {'count': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0}
+            stage['count'] += 1
+            stage['total_ms'] += duration_ms
+            stage['max_ms'] = max(stage['max_ms'], duration_ms)
+            if exc_type is not None:
+                stage['errors'] += 1
+            if _state.trace_path:
+                item = {
+                    'traceId': _state.trace_id,
+                    'spanId': self.span_id,
+                    'name': self.name,
+                    'kind': _SPAN_KIND_INTERNAL,
+                    'startTimeUnixNano': str(self.start_ns),
+                    'endTimeUnixNano': str(end_ns),
+                    'attributes': _otlp_attributes(self.attributes),
+                    'status': {'code': _STATUS_CODE_ERROR if exc_type is not None else _STATUS_CODE_OK},
+                }
+                if self.parent_id is not None:
+                    item['parentSpanId'] = self.parent_id
+                _state.spans.append(item)
+        if self.histogram:
+            observe(self.histogram, duration_ms)
+        return False
+
+
+def _otlp_value(value) -> dict:
+    # AnyValue OTLP/JSON: 64-битные целые передаются строкой
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def _otlp_attributes(attributes) -> list:
+    return [{'key': key, 'value': _otlp_value(value)} for key, value in attributes.items() if value is not None]
+
+
+def span(name, histogram=None, **attributes):
+    """
+    Контекстный менеджер замера этапа
+    @param name: Название этапа, например 'vk.ads.getStatistics' или 'google.decode'
+    @type name: str
+    @param histogram: Гистограмма, в которую добавляется длительность (например 'http_latency_ms')
+    @type histogram: str
+    @param attributes: Атрибуты спана
+    """
+    if not _state.enabled:
+        return _NOOP_SPAN
+    return _Span(name, histogram, attributes)
+
+
+def timed(name=None, histogram=None):
+    """
+    Декоратор замера функции
+    @param name: Название этапа, по умолчанию имя функции
+    @type name: str
+    @param histogram: См. span
+    @type histogram: str
+    """
+
+    def decorator(func):
+        stage_name = name or func.__name__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _state.enabled:
+                return func(*args, **kwargs)
+            with _Span(stage_name, histogram, {}):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def timed_iter(iterable, name, histogram=None, **attributes):
+    """
+    Генератор, который замеряет ожидание каждого элемента отдельным спаном, например ответа потокового
+    запроса. Время обработки элемента вызывающим кодом в замер не попадает
+    @param iterable: Итерируемый объект
+    @param name: Название этапа
+    @type name: str
+    @param histogram: См. span
+    @type histogram: str
+    @param attributes: Атрибуты спанов
+    """
+    iterator = iter(iterable)
+    while True:
+        with span(name, histogram, **attributes):
+            item = next(iterator, _END)
+        if item is _END:
+            return
+        yield item
+
+
+def submit(executor, func, *args, **kwargs):
+    """
+    Запуск функции в пуле потоков с копией текущего контекста, чтобы спаны потока
+    были вложены в текущий спан, а не становились корневыми
+    @param executor: Пул потоков
+    @type executor: concurrent.futures.Executor
+    @return: Future
+    """
+    return executor.submit(contextvars.copy_context().run, func, *args, **kwargs)
+
+
+def message_size(message) -> int:
+    """
+    Размер сообщения ответа API (proto-plus или protobuf) в байтах, 0 если размер неизвестен
+    """
+    pb = getattr(type(message), 'pb', None)
+    if pb is not None:
+        message = pb(message)
+    byte_size = getattr(message, 'ByteSize', None)
+    return byte_size() if callable(byte_size) else 0
+
+
+def run_summary(name) -> dict:
+    """
+    Сводка запуска: длительность, счетчики, этапы и гистограммы
+    @param name: Название выгрузки
+    @type name: str
+    @rtype: dict
+    """
+    with _state.lock:
+        return {
+            'export': name,
+            'trace_id': _state.trace_id,
+            'wall_time_s': round(time.time() - _state.started, 3),
+            'counters': dict(_state.counters),
+            'stages': {
+                stage: {**values, 'total_ms': round(values['total_ms'], 1), 'max_ms': round(values['max_ms'], 1)}
+                for stage, values in _state.stages.items()
+            },
+            'histograms': {
+                histogram: {**values, 'bounds_ms': _LATENCY_BUCKETS_MS}
+                for histogram, values in _state.histograms.items()
+            },
+        }
+
+
+def write_summary(name, path=None) -> dict:
+    """
+    Запись сводки запуска в лог и в файл, а накопленных спанов - в файл трассировки
+    @param name: Название выгрузки
+    @type name: str
+    @param path: Файл сводки, по умолчанию {ANALYTICS_EXPORT_DIR}/{name}_run_summary.json
+    @type path: str
+    @return: Сводка или None, если замеры выключены
+    @rtype: dict
+    """
+    if not _state.enabled:
+        return None
+    summary = run_summary(name)
+    logging.info(f"Run summary {json.dumps(summary)}")
+    if path is None:
+        state_dir = os.environ.get('ANALYTICS_EXPORT_DIR', '/tmp/analytics_export')
+        os.makedirs(state_dir, exist_ok=True)
+        path = os.path.join(state_dir, f"{name}_run_summary.json")
+    with open(path, 'w') as summary_file:
+        json.dump(summary, summary_file, indent=2)
+    if _state.trace_path:
+        with _state.lock:
+            spans, _state.spans = _state.spans, []
+        if spans:
+            request = {'resourceSpans': [{
+                'resource': {'attributes': _otlp_attributes({'service.name': name})},
+                'scopeSpans': [{'scope': {'name': _SCOPE_NAME}, 'spans': spans}],
+            }]}
+            with open(_state.trace_path, 'a') as trace_file:
+                trace_file.write(json.dumps(request) + '\n')
+    return summary
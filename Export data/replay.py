@@ -0,0 +1,578 @@
+""" Запись и воспроизведение ответов рекламных API для прогона выгрузок без доступа к API
+Ответы VK записываются прокси-сервером, который пересылает запросы в настоящее API, ответы Google Ads -
+оберткой над GoogleAdsService. При воспроизведении выгрузки работают с локальным HTTP-сервером VK
+и поддельным GoogleAdsService, которые отдают записанные ответы с заданной задержкой и ограничением частоты.
+
+Небольшой набор ответов для регрессионного прогона лежит в fixtures/ (см. test_replay.py).
+
+Запись:
+    python replay.py record-vk --fixtures fixtures/vk.json
+    python replay.py record-google --fixtures fixtures/google.json --credentials google_ads.json
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import types
+import argparse
+import tempfile
+import logging
+import threading
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+_EXPORT_DIR = os.path.dirname(os.path.abspath(__file__))
+VK_EXPORTER = os.path.join(_EXPORT_DIR, 'VK Ads API.py')
+GOOGLE_EXPORTER = os.path.join(_EXPORT_DIR, 'Google Ads API.py')
+
+_VK_API_URL = 'https://api.vk.com/method'
+# Параметры, которые не участвуют в ключе записанного ответа
+_VK_VOLATILE_PARAMS = {'access_token', 'date_from', 'date_to'}
+_DATE_RE = re.compile(r"'\d{4}-\d{2}-\d{2}'")
+_RATE_LIMIT_ERROR = {'error': {'error_code': 6, 'error_msg': 'Too many requests per second'}}
+
+
+class _AirflowStub:
+    """
+    Заглушка для объектов Airflow (HttpHook, EntityBuilderTemplate, Type ...), которые в выгрузках
+    используются без импорта. Любое обращение возвращает новую заглушку
+    """
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __call__(self, *args, **kwargs):
+        return _AirflowStub()
+
+    def __getattr__(self, name):
+        return _AirflowStub()
+
+
+class _SqlTypeStub:
+    """
+    Заглушка типа поля. Как и тип Airflow, имени типа в атрибутах нет, оно есть только в строке:
+    Type.VARCHAR выводится как 'Type.VARCHAR', Type.VARCHAR(32768) - как 'Type.VARCHAR(32768)' (см. frame_schema)
+    """
+
+    def __init__(self, text):
+        self._text = text
+
+    def __call__(self, *args):
+        return _SqlTypeStub(f"{self._text}({', '.join(map(str, args))})")
+
+    def __repr__(self):
+        return self._text
+
+
+class _TypeStub:
+    def __getattr__(self, name):
+        return _SqlTypeStub(f"Type.{name}")
+
+
+_AIRFLOW_NAMES = ['HttpHook', 'EntityBuilderTemplate', 'Stage', 'FetchListSourceOperator', 'Type', 'User']
+# Модули получения данных, которые импортирует выгрузка: паузы time.sleep в них масштабируются вместе с выгрузкой
+_FETCH_MODULES = ('vk_ads', 'google_ads')
+
+
+def load_exporter(path, sleep_scale=1.0) -> dict:
+    """
+    Загрузка выгрузки как модуля без Airflow
+    @param path: Путь к файлу выгрузки
+    @type path: str
+    @param sleep_scale: Множитель для пауз time.sleep внутри выгрузки и модулей _FETCH_MODULES, 0 - без пауз
+    @type sleep_scale: float
+    @return: Глобальные имена модуля выгрузки
+    @rtype: dict
+    """
+    if _EXPORT_DIR not in sys.path:
+        sys.path.insert(0, _EXPORT_DIR)
+    module_globals = {name: _AirflowStub() for name in _AIRFLOW_NAMES}
+    module_globals['Type'] = _TypeStub()
+    module_globals['__name__'] = os.path.splitext(os.path.basename(path))[0]
+    module_globals['__file__'] = path
+    with open(path) as source:
+        exec(compile(source.read(), path, 'exec'), module_globals)
+    scaled = time if sleep_scale == 1.0 else _scaled_time(sleep_scale)
+    namespaces = [module_globals] + [vars(sys.modules[name]) for name in _FETCH_MODULES if name in sys.modules]
+    for namespace in namespaces:
+        if 'time' in namespace:
+            namespace['time'] = scaled
+    return module_globals
+
+
+def _scaled_time(sleep_scale) -> types.ModuleType:
+    """
+    Модуль time, в котором паузы умножаются на sleep_scale
+    """
+    scaled = types.ModuleType('time')
+    scaled.__dict__.update(time.__dict__)
+    scaled.sleep = lambda seconds: time.sleep(seconds * sleep_scale)
+    return scaled
+
+
+def _read_fixtures(path) -> dict:
+    if path and os.path.exists(path):
+        with open(path) as fixtures_file:
+            return json.load(fixtures_file)
+    return {}
+
+
+def _write_fixtures(path, fixtures) -> None:
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as fixtures_file:
+        json.dump(fixtures, fixtures_file, ensure_ascii=False)
+
+
+class RequestStats:
+    """
+    Счетчики запросов к поддельным API
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.rate_limited = 0
+        self.missing = 0
+
+    def add(self, field) -> None:
+        with self._lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def as_dict(self) -> dict:
+        return {'requests': self.requests, 'rate_limited': self.rate_limited, 'missing': self.missing}
+
+
+class _RateLimiter:
+    """
+    Ограничение частоты: не больше rate_limit запросов за секунду, 0 - без ограничения
+    """
+
+    def __init__(self, rate_limit):
+        self.rate_limit = rate_limit
+        self._lock = threading.Lock()
+        self._window_start = time.monotonic()
+        self._count = 0
+
+    def allow(self) -> bool:
+        if not self.rate_limit:
+            return True
+        with self._lock:
+            now = time.monotonic()
+            if now - self._window_start >= 1:
+                self._window_start = now
+                self._count = 0
+            self._count += 1
+            return self._count <= self.rate_limit
+
+
+# VK
+
+def vk_request_key(method, params) -> str:
+    """
+    Ключ записанного ответа VK: метод и параметры без токена и дат
+    """
+    stable = {key: value for key, value in params.items() if key not in _VK_VOLATILE_PARAMS}
+    return f"{method}?{urllib.parse.urlencode(sorted(stable.items()))}"
+
+
+class FakeVkServer:
+    """
+    Локальный HTTP-сервер, повторяющий методы VK API по записанным ответам.
+    В режиме записи (upstream задан) пересылает запросы в настоящее API и сохраняет ответы
+    """
+
+    def __init__(self, fixtures_path, latency=0.0, rate_limit=0, upstream=None):
+        """
+        @param fixtures_path: Файл с записанными ответами
+        @type fixtures_path: str
+        @param latency: Задержка ответа в секундах
+        @type latency: float
+        @param rate_limit: Максимум запросов в секунду, сверх него отдается ошибка VK 6
+        @type rate_limit: int
+        @param upstream: Адрес настоящего API для записи, например https://api.vk.com/method
+        @type upstream: str
+        """
+        self.fixtures_path = fixtures_path
+        self.fixtures = _read_fixtures(fixtures_path)
+        self.latency = latency
+        self.limiter = _RateLimiter(rate_limit)
+        self.upstream = upstream
+        self.stats = RequestStats()
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_port}/method"
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                parsed = urllib.parse.urlparse(self.path)
+                method = parsed.path.rsplit('/', 1)[-1]
+                params = dict(urllib.parse.parse_qsl(parsed.query))
+                body = json.dumps(fake.respond(method, params)).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def respond(self, method, params) -> dict:
+        """
+        Ответ на один запрос к методу VK
+        """
+        self.stats.add('requests')
+        if self.latency:
+            time.sleep(self.latency)
+        if not self.limiter.allow():
+            self.stats.add('rate_limited')
+            return _RATE_LIMIT_ERROR
+        key = vk_request_key(method, params)
+        if self.upstream:
+            url = f"{self.upstream}/{method}?{urllib.parse.urlencode(params)}"
+            with urllib.request.urlopen(urllib.request.Request(url, method='POST')) as resp:
+                data = json.load(resp)
+            if 'response' in data:
+                with self._lock:
+                    self.fixtures[key] = data
+            return data
+        if key not in self.fixtures:
+            self.stats.add('missing')
+            logging.error(f"No recorded response for {key}")
+            return {'error': {'error_code': 100, 'error_msg': f'No recorded response for {key}'}}
+        return self.fixtures[key]
+
+    def start(self) -> 'FakeVkServer':
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+        if self.upstream:
+            _write_fixtures(self.fixtures_path, self.fixtures)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+# Google Ads
+
+def _select_fields(query) -> list:
+    """
+    Список полей из SELECT запроса GAQL
+    """
+    select = re.search(r'SELECT(.*?)FROM', query, re.S | re.I).group(1)
+    select = re.sub(r'--[^\n]*', '', select)
+    return [field.strip() for field in select.split(',') if field.strip()]
+
+
+def _attr_path(field) -> list:
+    return [part + '_' if part == 'type' else part for part in field.split('.')]
+
+
+def _encode_value(value):
+    """
+    Значение поля proto-plus в JSON: перечисления - по имени, повторяющиеся поля - списком
+    """
+    if hasattr(value, 'name') and hasattr(value, 'value') and isinstance(value.value, int):
+        return {'__enum__': value.name}
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    return [_encode_value(item) for item in value]
+
+
+def _encode_row(row, fields) -> dict:
+    encoded = {}
+    for field in fields:
+        value = row
+        for part in _attr_path(field):
+            value = getattr(value, part)
+        encoded['.'.join(_attr_path(field))] = _encode_value(value)
+    return encoded
+
+
+class _Message(types.SimpleNamespace):
+    """
+    Строка ответа Google Ads, собранная из записанных полей
+    """
+
+    def ByteSize(self) -> int:
+        # Размер ответа - размер записанной строки, для счетчика bytes (см. instrumentation.message_size)
+        return self.__dict__.get('_byte_size', 0)
+
+
+def _decode_value(value):
+    if isinstance(value, dict) and '__enum__' in value:
+        return types.SimpleNamespace(name=value['__enum__'])
+    return value
+
+
+def _decode_row(encoded) -> _Message:
+    row = _Message(_byte_size=len(json.dumps(encoded)))
+    for path, value in encoded.items():
+        node = row
+        parts = path.split('.')
+        for part in parts[:-1]:
+            if not hasattr(node, part):
+                setattr(node, part, _Message())
+            node = getattr(node, part)
+        setattr(node, parts[-1], _decode_value(value))
+    return row
+
+
+class FakeGoogleAdsException(Exception):
+    """
+    Записанная ошибка API: коды ошибок доступны как failure.errors[].error_code, как у GoogleAdsException
+    """
+
+    def __init__(self, codes):
+        super().__init__(', '.join(codes))
+        self.failure = types.SimpleNamespace(errors=[types.SimpleNamespace(error_code=code) for code in codes])
+
+
+def _error_codes(error) -> list:
+    """
+    Коды ошибок GoogleAdsException для записи, например 'authorization_error: CUSTOMER_NOT_ENABLED'
+    """
+    failure = getattr(error, 'failure', None)
+    if failure is None:
+        return None
+    return [' '.join(str(item.error_code).split()) for item in failure.errors]
+
+
+def google_request_key(customer_id, query) -> str:
+    """
+    Ключ записанного ответа Google Ads: кабинет и запрос без дат
+    """
+    return f"{customer_id}|{' '.join(_DATE_RE.sub('?', query).split())}"
+
+
+class FakeGoogleAdsService:
+    """
+    GoogleAdsService, который отдает записанные ответы search и search_stream
+    """
+
+    def __init__(self, fixtures, latency=0.0, rate_limit=0, stats=None):
+        self.fixtures = fixtures
+        self.latency = latency
+        self.limiter = _RateLimiter(rate_limit)
+        self.stats = stats or RequestStats()
+
+    def _call(self, method, customer_id, query) -> list:
+        self.stats.add('requests')
+        if self.latency:
+            time.sleep(self.latency)
+        if not self.limiter.allow():
+            self.stats.add('rate_limited')
+            raise RuntimeError('RESOURCE_EXHAUSTED: Too many requests')
+        key = google_request_key(customer_id, query)
+        rows = self.fixtures.get(method, {}).get(key)
+        if rows is None:
+            self.stats.add('missing')
+            raise RuntimeError(f'No recorded response for {key}')
+        if isinstance(rows, dict) and '__error__' in rows:
+            raise FakeGoogleAdsException(rows['__error__'])
+        return [_decode_row(row) for row in rows]
+
+    def search_stream(self, request):
+        results = self._call('search_stream', request.customer_id, request.query)
+        yield _Message(results=results, _byte_size=sum(row.ByteSize() for row in results))
+
+    def search(self, customer_id, query):
+        return self._call('search', customer_id, query)
+
+    @staticmethod
+    def parse_customer_path(resource_name) -> dict:
+        return {'customer_id': resource_name.split('/')[-1]}
+
+
+class FakeCustomerService:
+    def __init__(self, fixtures):
+        self.fixtures = fixtures
+
+    def list_accessible_customers(self):
+        return types.SimpleNamespace(resource_names=self.fixtures.get('accessible_customers', []))
+
+
+class FakeGoogleAdsClient:
+    """
+    Замена GoogleAdsClient для воспроизведения. Настраивается через configure до загрузки выгрузки
+    """
+    fixtures = {}
+    latency = 0.0
+    rate_limit = 0
+    stats = RequestStats()
+    _service = None
+
+    @classmethod
+    def configure(cls, fixtures_path, latency=0.0, rate_limit=0) -> None:
+        cls.fixtures = _read_fixtures(fixtures_path)
+        cls.latency = latency
+        cls.rate_limit = rate_limit
+        cls.stats = RequestStats()
+        cls._service = FakeGoogleAdsService(cls.fixtures, latency, rate_limit, cls.stats)
+
+    @classmethod
+    def load_from_dict(cls, cred_dict, version=None) -> 'FakeGoogleAdsClient':
+        return cls()
+
+    def get_service(self, name):
+        if self._service is None:
+            raise RuntimeError("FakeGoogleAdsClient is not configured: call "
+                               "FakeGoogleAdsClient.configure(fixtures_path) before running the exporter")
+        if name == 'CustomerService':
+            return FakeCustomerService(self.fixtures)
+        return self._service
+
+    @staticmethod
+    def get_type(name):
+        return types.SimpleNamespace()
+
+
+def install_fake_google_ads() -> None:
+    """
+    Подмена модуля google.ads.googleads.client, чтобы выгрузка загружалась без библиотеки google-ads
+    """
+    for name in ['google', 'google.ads', 'google.ads.googleads']:
+        sys.modules.setdefault(name, types.ModuleType(name))
+    client_module = types.ModuleType('google.ads.googleads.client')
+    client_module.GoogleAdsClient = FakeGoogleAdsClient
+    sys.modules['google.ads.googleads.client'] = client_module
+
+
+class RecordingGoogleAdsService:
+    """
+    Обертка над настоящим GoogleAdsService, которая сохраняет ответы в fixtures
+    """
+
+    def __init__(self, service, fixtures):
+        self._service = service
+        self.fixtures = fixtures
+
+    def _record(self, method, customer_id, query, rows) -> None:
+        fields = _select_fields(query)
+        self.fixtures.setdefault(method, {})[google_request_key(customer_id, query)] = [
+            _encode_row(row, fields) for row in rows
+        ]
+
+    def _record_error(self, method, customer_id, query, error) -> None:
+        # Ошибки API (например отключенный кабинет) тоже воспроизводятся
+        codes = _error_codes(error)
+        if codes:
+            self.fixtures.setdefault(method, {})[google_request_key(customer_id, query)] = {'__error__': codes}
+
+    def search_stream(self, request):
+        rows = []
+        try:
+            for batch in self._service.search_stream(request):
+                rows.extend(batch.results)
+                yield batch
+        except Exception as e:
+            self._record_error('search_stream', request.customer_id, request.query, e)
+            raise
+        self._record('search_stream', request.customer_id, request.query, rows)
+
+    def search(self, customer_id, query):
+        try:
+            rows = list(self._service.search(customer_id=customer_id, query=query))
+        except Exception as e:
+            self._record_error('search', customer_id, query, e)
+            raise
+        self._record('search', customer_id, query, rows)
+        return rows
+
+    def __getattr__(self, name):
+        return getattr(self._service, name)
+
+
+class RecordingGoogleAdsClient:
+    """
+    Обертка над настоящим GoogleAdsClient для записи ответов
+    """
+
+    def __init__(self, client, fixtures):
+        self._client = client
+        self.fixtures = fixtures
+
+    def get_service(self, name):
+        service = self._client.get_service(name)
+        if name == 'GoogleAdsService':
+            return RecordingGoogleAdsService(service, self.fixtures)
+        if name == 'CustomerService':
+            resource_names = list(service.list_accessible_customers().resource_names)
+            self.fixtures['accessible_customers'] = resource_names
+        return service
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+def _consume(batches) -> int:
+    return sum(batch.shape[0] for batch in batches)
+
+
+def record_vk(fixtures_path) -> None:
+    """
+    Прогон выгрузки VK через прокси-сервер с записью ответов настоящего API
+    """
+    # Чистое локальное состояние, чтобы выгрузка запросила все данные
+    os.environ['ANALYTICS_EXPORT_DIR'] = tempfile.mkdtemp()
+    os.environ['ANALYTICS_INDEX_DIR'] = os.path.join(os.environ['ANALYTICS_EXPORT_DIR'], 'index')
+    with FakeVkServer(fixtures_path, upstream=_VK_API_URL) as server:
+        os.environ['VK_API_URL'] = server.url
+        exporter = load_exporter(VK_EXPORTER)
+        logging.info(f"Recorded {_consume(exporter['main']())} rows, {server.stats.requests} requests")
+
+
+def record_google(fixtures_path, credentials_path) -> None:
+    """
+    Прогон выгрузки Google Ads с записью ответов настоящего API
+    @param credentials_path: JSON с developer_token, refresh_token, client_id, client_secret
+    """
+    with open(credentials_path) as credentials_file:
+        credentials = json.load(credentials_file)
+    fixtures = _read_fixtures(fixtures_path)
+    # Чистое локальное состояние, чтобы выгрузка запросила иерархию аккаунтов и все данные
+    os.environ['ANALYTICS_EXPORT_DIR'] = tempfile.mkdtemp()
+    os.environ['ANALYTICS_INDEX_DIR'] = os.path.join(os.environ['ANALYTICS_EXPORT_DIR'], 'index')
+    exporter = load_exporter(GOOGLE_EXPORTER)
+    create_client = exporter['create_client']
+    exporter['get_creeds'] = lambda login_customer_id=None: {
+        **credentials, 'use_proto_plus': True, 'login_customer_id': login_customer_id
+    }
+    exporter['create_client'] = lambda cred_dict: RecordingGoogleAdsClient(create_client(cred_dict), fixtures)
+    try:
+        logging.info(f"Recorded {_consume(exporter['main']())} rows")
+    finally:
+        _write_fixtures(fixtures_path, fixtures)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['record-vk', 'record-google'])
+    parser.add_argument('--fixtures', required=True)
+    parser.add_argument('--credentials', help='JSON с кредами Google Ads для record-google')
+    args = parser.parse_args()
+    if args.command == 'record-vk':
+        record_vk(args.fixtures)
+    else:
+        record_google(args.fixtures, args.credentials)
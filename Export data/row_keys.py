@@ -0,0 +1,237 @@
+""" Ключ инкремента и отбор изменившихся строк на стороне выгрузки
+Ключ строки - 128-битный хэш ключевых колонок, хэш содержимого - 64-битный хэш остальных колонок.
+Индекс ключ -> хэш содержимого хранится между запусками, поэтому повторно выгружаемые
+дни скользящего окна отдают в хранилище только новые и изменившиеся строки.
+
+Индекс обновляется в два шага: выгрузка сохраняет новый индекс как ожидающий ({name}.pending.parquet),
+а подтверждает его confirm_callback после успешной загрузки в хранилище (on_success_callback DAG).
+Если загрузка упала, ожидающий индекс не подтверждается и следующий запуск отправит строки повторно.
+
+Индекс должен лежать в общем хранилище, доступном всем воркерам Airflow и процессу, выполняющему
+колбэки DAG (планировщик): каталог задается обязательной переменной окружения ANALYTICS_INDEX_DIR.
+Значения по умолчанию нет - локальный /tmp воркера не виден планировщику, и индекс никогда
+не подтверждался бы. Если ожидающего индекса при подтверждении нет, confirm падает с ошибкой.
+"""
+
+import os
+import logging
+
+import numpy as np
+import pandas as pd
+
+
+_INDEX_DIR_ENV = 'ANALYTICS_INDEX_DIR'
+# Ключи хэширования для двух половин 128-битного ключа (ровно 16 символов)
+_KEY_HASH_KEYS = ('analytics_rowkey', 'rowkey_analytics')
+_INDEX_COLUMNS = ['key_hi', 'key_lo', 'content_hash', 'date']
+_HEX_DIGITS = np.frombuffer(b'0123456789abcdef', dtype=np.uint8)
+
+
+def index_dir(base_dir=None) -> str:
+    """
+    Каталог индексов: base_dir или ANALYTICS_INDEX_DIR
+    @param base_dir: Явно заданный каталог
+    @type base_dir: str
+    @rtype: str
+    """
+    base_dir = base_dir or os.environ.get(_INDEX_DIR_ENV)
+    if not base_dir:
+        raise ValueError(f"{_INDEX_DIR_ENV} is not set: the row index must be on storage shared by "
+                         f"the Airflow workers and the scheduler, which confirms it")
+    return base_dir
+
+
+def _hash_columns(df, hash_key=None) -> np.ndarray:
+    """
+    Векторный 64-битный хэш строк фрейма. Значения приводятся к строкам, чтобы хэш не зависел
+    от того, пришел идентификатор числом или строкой, а колонки хэшируются по отдельности,
+    поэтому значения соседних колонок не склеиваются
+    @param df: Фрейм с хэшируемыми колонками
+    @type df: pd.DataFrame
+    @param hash_key: Ключ хэширования
+    @type hash_key: str
+    @return: Массив uint64
+    @rtype: np.ndarray
+    """
+    kwargs = {'hash_key': hash_key} if hash_key else {}
+    return pd.util.hash_pandas_object(df.astype(str), index=False, **kwargs).to_numpy()
+
+
+def row_key_parts(df, key_columns) -> tuple:
+    """
+    Две половины 128-битного ключа строки
+    @param df: Фрейм
+    @type df: pd.DataFrame
+    @param key_columns: Колонки, образующие ключ
+    @type key_columns: list
+    @return: Пара массивов uint64 (старшая и младшая половина)
+    @rtype: tuple
+    """
+    keys = df[key_columns]
+    return _hash_columns(keys, _KEY_HASH_KEYS[0]), _hash_columns(keys, _KEY_HASH_KEYS[1])
+
+
+def format_row_key(key_hi, key_lo) -> np.ndarray:
+    """
+    Представление 128-битного ключа в виде hex-строки из 32 символов. Байты ключа переводятся в цифры
+    таблицей, без цикла по строкам
+    @rtype: np.ndarray
+    """
+    raw = np.empty((len(key_hi), 2), dtype='>u8')
+    raw[:, 0] = key_hi
+    raw[:, 1] = key_lo
+    raw = raw.view(np.uint8)
+    digits = np.empty((raw.shape[0], 32), dtype=np.uint8)
+    digits[:, 0::2] = _HEX_DIGITS[raw >> 4]
+    digits[:, 1::2] = _HEX_DIGITS[raw & 15]
+    return digits.view('S32').ravel().astype(str)
+
+
+def content_hash(df, exclude_columns) -> np.ndarray:
+    """
+    Хэш содержимого строки по всем колонкам, кроме исключенных
+    @param df: Фрейм
+    @type df: pd.DataFrame
+    @param exclude_columns: Колонки, не участвующие в хэше (ключ и ключевые колонки)
+    @type exclude_columns: list
+    @return: Массив uint64
+    @rtype: np.ndarray
+    """
+    columns = sorted(column for column in df.columns if column not in set(exclude_columns))
+    return _hash_columns(df[columns])
+
+
+class RowIndex:
+    """
+    Индекс ключ строки -> хэш содержимого по прошлым запускам выгрузки
+    """
+
+    def __init__(self, name, key_columns, key_column, date_column, base_dir=None):
+        """
+        @param name: Название выгрузки, например 'vk_ads'
+        @type name: str
+        @param key_columns: Колонки, образующие ключ строки
+        @type key_columns: list
+        @param key_column: Колонка, в которую записывается ключ инкремента
+        @type key_column: str
+        @param date_column: Колонка с датой статистики, по ней из индекса удаляются старые дни
+        @type date_column: str
+        @param base_dir: Каталог индексов, по умолчанию ANALYTICS_INDEX_DIR
+        @type base_dir: str
+        """
+        base_dir = index_dir(base_dir)
+        self.key_columns = list(key_columns)
+        self.key_column = key_column
+        self.date_column = date_column
+        os.makedirs(base_dir, exist_ok=True)
+        self.path = os.path.join(base_dir, f"{name}.parquet")
+        self.pending_path = pending_path(name, base_dir)
+        if os.path.exists(self.path):
+            self._index = pd.read_parquet(self.path)
+        else:
+            self._index = pd.DataFrame({
+                'key_hi': np.array([], dtype='uint64'),
+                'key_lo': np.array([], dtype='uint64'),
+                'content_hash': np.array([], dtype='uint64'),
+                'date': np.array([], dtype=str),
+            })
+        self._pending = []
+
+    def filter_changed(self, df) -> pd.DataFrame:
+        """
+        Добавляет во фрейм ключ инкремента и оставляет только новые и изменившиеся строки.
+        Обновления индекса копятся до commit
+        @param df: Фрейм партиции
+        @type df: pd.DataFrame
+        @return: Фрейм новых и изменившихся строк или None, если таких нет
+        @rtype: pd.DataFrame
+        """
+        if df is None or df.empty:
+            return df
+        key_hi, key_lo = row_key_parts(df, self.key_columns)
+        hashes = pd.DataFrame({
+            'key_hi': key_hi,
+            'key_lo': key_lo,
+            'content_hash': content_hash(df, self.key_columns + [self.key_column]),
+            'date': df[self.date_column].astype(str).to_numpy(),
+        })
+        known = hashes.merge(self._index[['key_hi', 'key_lo', 'content_hash']], how='left',
+                             on=['key_hi', 'key_lo'], suffixes=('', '_known'))
+        changed = (known['content_hash'] != known['content_hash_known']).to_numpy()
+
+        self._pending.append(hashes[changed])
+        df = df.copy()
+        df[self.key_column] = format_row_key(key_hi, key_lo)
+        logging.info(f"Changed rows {changed.sum()} of {len(changed)}")
+        if not changed.any():
+            return None
+        return df[changed].reset_index(drop=True)
+
+    def commit(self, min_date=None) -> None:
+        """
+        Сохранение индекса с накопленными обновлениями как ожидающего подтверждения загрузки.
+        Ожидающий индекс предыдущего запуска, загрузка которого не подтверждена, заменяется:
+        строки того запуска уже заново попали в обновления этого
+        @param min_date: Дни раньше этой даты ('YYYY-MM-DD') удаляются из индекса,
+         так как больше не попадают в окно выгрузки
+        @type min_date: str
+        """
+        index = pd.concat([self._index] + self._pending, ignore_index=True)
+        index = index.drop_duplicates(['key_hi', 'key_lo'], keep='last')
+        if min_date is not None:
+            index = index[index['date'] >= str(min_date)]
+        tmp_path = f"{self.pending_path}.{os.getpid()}.tmp"
+        index[_INDEX_COLUMNS].to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, self.pending_path)
+        self._pending = []
+
+    def commit_after(self, batches, min_date=None):
+        """
+        Генератор, который отдает партиции и сохраняет ожидающий индекс после того, как прочитаны все.
+        Действующим индекс становится только после confirm, то есть после успешной загрузки
+        @param batches: Генератор партиций
+        @param min_date: См. commit
+        @type min_date: str
+        @return: Генератор pd.DataFrame
+        """
+        yield from batches
+        self.commit(min_date)
+
+
+def pending_path(name, base_dir=None) -> str:
+    return os.path.join(index_dir(base_dir), f"{name}.pending.parquet")
+
+
+def confirm(name, base_dir=None) -> None:
+    """
+    Подтверждение загрузки: ожидающий индекс выгрузки становится действующим.
+    Если ожидающего индекса нет (каталог индексов не общий для воркера и планировщика или выгрузка
+    не дочитана до конца), пробрасывается ошибка: иначе отбор строк молча перестал бы продвигаться
+    @param name: Название выгрузки, например 'vk_ads'
+    @type name: str
+    @param base_dir: Каталог индексов, по умолчанию ANALYTICS_INDEX_DIR
+    @type base_dir: str
+    """
+    base_dir = index_dir(base_dir)
+    path = pending_path(name, base_dir)
+    try:
+        os.replace(path, os.path.join(base_dir, f"{name}.parquet"))
+    except FileNotFoundError:
+        logging.error(f"No pending row index for {name} at {path}")
+        raise
+    logging.info(f"Row index of {name} confirmed")
+
+
+def confirm_callback(name, base_dir=None):
+    """
+    Колбэк для on_success_callback DAG: после успешной загрузки подтверждает индекс выгрузки.
+    Одновременные запуски одной выгрузки не поддерживаются (max_active_runs=1)
+    @param name: Название выгрузки
+    @type name: str
+    @return: Функция callback(context)
+    """
+
+    def callback(context=None):
+        confirm(name, base_dir)
+
+    return callback
@@ -0,0 +1,43 @@
+""" Регрессионный прогон выгрузок на записанных ответах API из fixtures/ (см. replay.py)
+Каждая выгрузка запускается через benchmark.run_isolated: отдельный процесс с чистым локальным состоянием.
+
+    python -m pytest "Export data/test_replay.py"
+"""
+
+import os
+
+import pytest
+
+import replay
+import benchmark
+
+
+_FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def _run(exporter) -> dict:
+    return benchmark.run_isolated(exporter, os.path.join(_FIXTURES_DIR, f'{exporter}.json'))
+
+
+def test_vk_main():
+    result = _run('vk')
+    # 2 клиента x 3 объявления x 2 дня
+    assert result['rows'] == 12
+    assert result['missing'] == 0
+    assert result['rate_limited'] == 0
+    assert 'cast_errors' not in result['counters']
+
+
+def test_google_main():
+    result = _run('google')
+    # 2 кабинета x 2 дня x (2 объявления + 1 кампания Performance Max), кабинет 4 без доступа пропускается
+    assert result['rows'] == 12
+    assert result['missing'] == 0
+    assert result['counters']['skipped_cabinets'] == 1
+    assert 'cast_errors' not in result['counters']
+
+
+def test_fake_google_client_requires_configure(monkeypatch):
+    monkeypatch.setattr(replay.FakeGoogleAdsClient, '_service', None)
+    with pytest.raises(RuntimeError, match='configure'):
+        replay.FakeGoogleAdsClient().get_service('GoogleAdsService')
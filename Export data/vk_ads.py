@@ -0,0 +1,276 @@
+""" Получение статистики VK по объявлениям клиентов рекламных кабинетов
+Модуль без побочных эффектов при импорте, его используют выгрузка VK Ads API.py и источники ad_sources.py
+"""
+
+import os
+import requests
+import pandas as pd
+import logging
+import time
+from datetime import datetime, timedelta
+import instrumentation
+from frame_schema import schema_from_fields, cast_frame
+
+
+TOKEN = '11111111111111111111111111111'
+_VERSION = 5.131
+IDS_RK = [11111111111, 222222222]
+_API_URL = 'https://api.vk.com/method'
+
+
+class PermissionDenied(Exception):
+    """
+    Ошибка VK 600: нет доступа к кабинету или клиенту, повторные попытки не помогут
+    """
+
+
+def _method_url(method) -> str:
+    # Адрес API читается при каждом запросе, его можно переопределить, например для прогона
+    # на записанных ответах (replay.py)
+    return f"{os.environ.get('VK_API_URL', _API_URL)}/{method}"
+
+
+def trying(func) -> list:
+    """
+    Декоратор для попыток получения данных и логирования процессов
+    """
+
+    def wrapper(*args, **kwargs):
+        tryin = 0
+        while tryin < 11:
+            data = func(*args, **kwargs)
+            if 'response' in data:
+                logging.info(f"Response {func.__name__} true")
+                return data['response']
+            else:
+                if 'error' in data and data['error']['error_code'] == 600:
+                    # "Permission denied" не повторяется
+                    raise PermissionDenied(data['error']['error_msg'])
+                tryin += 1
+                instrumentation.incr('retries')
+                logging.error(f'tryin: {tryin}')
+                logging.error(data['error']['error_msg'])
+                time.sleep(10)
+                continue
+        raise Exception('No response in data')
+
+    return wrapper
+
+
+def _post(vk_accounts_url, params) -> dict:
+    """
+    Запрос к методу VK API с замером задержки и объема ответа
+    """
+    method = vk_accounts_url.rsplit('/', 1)[-1]
+    with instrumentation.span(f'vk.{method}', histogram='http_latency_ms', account_id=params.get('account_id')):
+        resp = requests.post(vk_accounts_url, params=params)
+    instrumentation.incr('requests')
+    instrumentation.incr('bytes', len(resp.content))
+    return resp.json()
+
+
+@trying
+def get_rk_list(token, id_rk) -> dict:
+    """
+    Функция возвращает список клиентов в рекламном кабинете
+    """
+    vk_accounts_url = _method_url('ads.getClients')
+    params = {
+        'access_token': token,
+        'v': 5.131,
+        'account_id': id_rk
+    }
+    return _post(vk_accounts_url, params)
+
+
+@trying
+def getAdsData(token, id_rk, client_id) -> dict:
+    """
+    Функция возвращает список рекламных объявлений для каждого клиента
+    """
+    vk_accounts_url = _method_url('ads.getAds')
+    params = {
+        'access_token': token,
+        'v': 5.131,
+        'account_id': id_rk,
+        'include_deleted': 1,
+        'client_id': client_id
+    }
+    return _post(vk_accounts_url, params)
+
+
+@trying
+def getStatistics(token, id_rk, ids, date_from, date_to) -> dict:
+    """
+    Функция возвращает статситку по объявлениям в разрезе дней
+    """
+    vk_accounts_url = _method_url('ads.getStatistics')
+    params = {
+        'access_token': token,
+        'v': 5.131,
+        'account_id': id_rk,
+        'ids_type': 'ad',
+        'period': 'day',
+        'ids': ids,
+        'date_from': date_from,
+        'date_to': date_to
+    }
+    return _post(vk_accounts_url, params)
+
+
+@trying
+def getCampaigns(token, id_rk, client_id) -> dict:
+    """
+    Функция возвращает список рекламных кампаний
+    """
+    vk_accounts_url = _method_url('ads.getCampaigns')
+    params = {
+        'access_token': token,
+        'v': 5.131,
+        'account_id': id_rk,
+        'include_deleted': 1,
+        'client_id': client_id
+    }
+    return _post(vk_accounts_url, params)
+
+
+_ADS_COLUMNS = ['id', 'campaign_id', 'status', 'approved', 'create_time', 'update_time', 'goal_type', 'day_limit',
+                'all_limit', 'start_time', 'stop_time', 'category1_id', 'category2_id', 'age_restriction', 'name',
+                'events_retargeting_groups', 'cost_type', 'ad_format', 'cpc', 'ad_platform',
+                'ad_platform_no_ad_network', 'cpm', 'impressions_limit']
+
+def _call(func, *args):
+    return func(*args)
+
+
+def get_client_data(id_rk, param, date_from=None, date_to=None, call=_call) -> pd.DataFrame:
+    """
+    Функция возвращает статистику по объявлениям одного клиента рекламного кабинета,
+    по умолчанию за последние 3 дня, не включая текущий
+    @param id_rk: Идентификатор рекламного кабинета
+    @type id_rk: int
+    @param param: Клиент из get_rk_list
+    @type param: dict
+    @param date_from: Дата начала в формате 'YYYY-MM-DD'
+    @type date_from: str
+    @param date_to: Дата окончания в формате 'YYYY-MM-DD'
+    @type date_to: str
+    @param call: Функция вызова метода API call(func, *args), например с ограничением частоты запросов
+    @type call: callable
+    @return: Фрейм статистики или None, если статистики нет
+    @rtype: pd.DataFrame
+    """
+    date_from = date_from or (datetime.now() - timedelta(days=3)).strftime("%Y-%m-%d")
+    date_to = date_to or (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d")
+    # Получаем список объявлений
+    dataAds = call(getAdsData, TOKEN, id_rk, param['id'])
+    # Получаем список кампаний (нужно для названий)
+    dataCampaigns = call(getCampaigns, TOKEN, id_rk, param['id'])
+    df_campaigns = pd.DataFrame(dataCampaigns)
+    df_campaigns = df_campaigns.rename(columns={'id': 'campaign_id',
+                                                'name': 'campaign_name',
+                                                'type': 'campaign_type'})
+    df_campaigns = df_campaigns[['campaign_id', 'campaign_name', 'campaign_type']]
+    df_campaigns['project_id'] = param['id']
+
+    # Считаем количество чанок
+    rng = (len(dataAds) // 2000) + 1
+    logging.info(f"Len rng {rng}")
+    start_chunk = 0
+    finish_chunk = 2000
+    res_ads = []
+
+    # Проходимся по чанкам и получаем статистику по объявлениям
+    for x in range(rng):
+        logging.info(f"Start chunk {x}")
+        d_ad = pd.DataFrame(dataAds[start_chunk:finish_chunk])
+        d_ad['id'] = d_ad.id.astype(str)
+        id_str = ','.join(d_ad['id'].tolist())
+
+        data = call(getStatistics, TOKEN, id_rk, id_str, date_from, date_to)
+
+        res_ads.extend(data)
+        logging.info(f"start_chunk: {start_chunk}, finish_chunk: {finish_chunk}")
+        start_chunk += 2000
+        finish_chunk += 2000
+        time.sleep(1)
+
+    return _build_client_frame(param, dataAds, df_campaigns, res_ads)
+
+
+# Типы полей фрейма выгрузки (имена типов хранилища): расход передается целым числом микро-единиц
+SOURCE_TYPES = {
+    'ads_unique_key': 'VARCHAR',
+    'ad_id': 'BIGINT',
+    'ad_name': 'VARCHAR',
+    'campaign_id': 'BIGINT',
+    'campaign_name': 'VARCHAR',
+    'campaign_type': 'VARCHAR',
+    'ad_type': 'VARCHAR',
+    'project_name': 'VARCHAR',
+    'project_id': 'BIGINT',
+    'day': 'DATE',
+    'spent_micros': 'BIGINT',
+    'impressions': 'BIGINT',
+    'clicks': 'BIGINT',
+    'reach': 'BIGINT'
+}
+
+# Схема фрейма клиента: расход из рублей в микро-единицы, типы кампаний и объявлений - категории
+_FRAME_SCHEMA = schema_from_fields(
+    SOURCE_TYPES,
+    kinds={'spent_micros': 'micros', 'campaign_type': 'category', 'ad_type': 'category'},
+    exclude=('ads_unique_key',)
+)
+
+
+@instrumentation.timed('vk.transform')
+def _build_client_frame(param, dataAds, df_campaigns, res_ads) -> pd.DataFrame:
+    """
+    Функция собирает фрейм статистики клиента из ответов API
+    @param param: Клиент из get_rk_list
+    @type param: dict
+    @param dataAds: Объявления клиента из getAdsData
+    @type dataAds: list
+    @param df_campaigns: Кампании клиента
+    @type df_campaigns: pd.DataFrame
+    @param res_ads: Статистика объявлений из getStatistics
+    @type res_ads: list
+    @return: Фрейм статистики или None, если статистики нет
+    @rtype: pd.DataFrame
+    """
+    # Объявления нужны только этого клиента, поэтому не копим их между клиентами
+    data_ad = pd.DataFrame(dataAds, columns=_ADS_COLUMNS)
+    data_ad['project_name'] = param['name']
+    data_ad['project_id'] = param['id']
+    statistics = list()
+    for pr in res_ads:
+        for st in pr['stats']:
+            dict_params = {
+                'id': pr['id'],
+                'type': pr['type'],
+                'project_id': param['id']
+            }
+            statistics.append({**dict_params, **st})
+    stats = pd.DataFrame(statistics)
+    # проверяем наличие данных в статистике
+    if stats.shape[0] == 0:
+        return None
+    stats = stats.fillna(0)
+    logging.info(f'stats {stats.shape}, ads {data_ad.shape}')
+
+    stats = stats.astype('object')
+    data_ad = data_ad.astype('object')
+    data_ad['id'] = data_ad['id'].astype('int64').astype('object')
+
+    df = pd.merge(stats, data_ad, on=['project_id', 'id'], how='left')
+    df = pd.merge(df, df_campaigns, on=['project_id', 'campaign_id'], how='left')
+
+    df = df.rename(columns={'id': 'ad_id',
+                            'name': 'ad_name',
+                            'type': 'ad_type',
+                            'spent': 'spent_micros'
+                            })
+    # Приведение к схеме, метрики, которых нет в статистике, заполняются нулями
+    df, _ = cast_frame(df, _FRAME_SCHEMA, name=f"client {param['id']}")
+    return df
@@ -1,27 +1,28 @@
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
 from tqdm import tqdm
-from scipy.stats import norm, mannwhitneyu
+from scipy.stats import norm
+from .result_cache import cached
 
-def get_bootstrap(
+
+@cached(ignore=('progress',), requires=('random_state',))
+def bootstrap_diff(
         data_column_1,  # числовые значения первой выборки
         data_column_2,  # числовые значения второй выборки
         boot_it=3000,  # количество бутстрэп-подвыборок
         statistic=np.mean,  # интересующая нас статистика
-        bootstrap_conf_level=0.95  # уровень значимости
+        bootstrap_conf_level=0.95,  # уровень значимости
+        random_state=None,  # seed, при заданном seed результат берется из кэша (см. result_cache.py)
+        progress=True  # показывать прогресс
 ):
+    rng = np.random.default_rng(random_state)
+    # Подвыборки - индексы с возвращением по массивам numpy, поэтому подходят и pd.Series, и np.ndarray
+    values_1 = np.asarray(data_column_1)
+    values_2 = np.asarray(data_column_2)
     boot_data = []
-    for i in tqdm(range(boot_it)):  # извлекаем подвыборки
-        samples_1 = data_column_1.sample(
-            len(data_column_1),
-            replace=True  # параметр возвращения
-        ).values
-
-        samples_2 = data_column_2.sample(
-            len(data_column_2),
-            replace=True
-        ).values
+    for i in tqdm(range(boot_it), disable=not progress):  # извлекаем подвыборки
+        samples_1 = values_1[rng.integers(0, len(values_1), len(values_1))]
+        samples_2 = values_2[rng.integers(0, len(values_2), len(values_2))]
 
         boot_data.append(statistic(samples_1) - statistic(samples_2))  # mean() - применяем статистику
 
@@ -43,19 +44,41 @@ def get_bootstrap(
     )
     p_value = min(p_1, p_2) * 2
 
-    # Визуализация
+    return {"boot_data": boot_data,
+            "ci": ci,
+            "p_value": p_value}
+
+
+def plot_bootstrap(booted_data):
+    # Визуализация, matplotlib импортируется только здесь, чтобы расчет в процессах выгрузки не тянул графику
+    import matplotlib.pyplot as plt
+
+    pd_boot_data = pd.DataFrame(booted_data["boot_data"])
     plt.hist(pd_boot_data[0], bins=50)
 
     plt.style.use('ggplot')
-    plt.vlines(ci, ymin=0, ymax=50, linestyle='--')
+    plt.vlines(booted_data["ci"], ymin=0, ymax=50, linestyle='--')
     plt.xlabel('boot_data')
     plt.ylabel('frequency')
     plt.title("Histogram of boot_data")
     plt.show()
 
-    return {"boot_data": boot_data,
-            "ci": ci,
-            "p_value": p_value}
+
+def get_bootstrap(
+        data_column_1,  # числовые значения первой выборки
+        data_column_2,  # числовые значения второй выборки
+        boot_it=3000,  # количество бутстрэп-подвыборок
+        statistic=np.mean,  # интересующая нас статистика
+        bootstrap_conf_level=0.95,  # уровень значимости
+        random_state=None,  # seed для воспроизводимого результата и кэша
+        plot=True  # строить гистограмму
+):
+    booted_data = bootstrap_diff(data_column_1, data_column_2, boot_it, statistic, bootstrap_conf_level,
+                                 random_state)
+    if plot:
+        plot_bootstrap(booted_data)
+    return booted_data
 
 
-booted_data = get_bootstrap(A, B, boot_it=10000)  # в результате хранится разница двух распределений, ДИ и pvalue
+# Пример: booted_data = get_bootstrap(A, B, boot_it=10000, random_state=0)
+# в результате хранится разница двух распределений, ДИ и pvalue
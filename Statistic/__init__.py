@@ -0,0 +1,32 @@
+""" Статистика A/B тестов: бутстрэп, байесовское сравнение конверсий, Манн-Уитни по гистограммам,
+кэш результатов и расчет многих экспериментов (python -m Statistic, см. readout.py).
+Модули импортируются при первом обращении к имени, поэтому import Statistic не загружает pandas и scipy.
+"""
+
+import importlib
+
+
+_EXPORTS = {
+    'get_bootstrap': 'Bootstrap',
+    'bootstrap_diff': 'Bootstrap',
+    'plot_bootstrap': 'Bootstrap',
+    'calc_prob_between': 'bayesian',
+    'prob_test_better': 'bayesian',
+    'mannwhitneyu': 'rank_tests',
+    'mannwhitneyu_counts': 'rank_tests',
+    'mannwhitneyu_batch': 'rank_tests',
+    'value_counts': 'rank_tests',
+    'cached': 'result_cache',
+    'read_experiments': 'readout',
+    'analyze_experiment': 'readout',
+    'run_readout': 'readout',
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    module = _EXPORTS.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return getattr(importlib.import_module(f".{module}", __name__), name)
@@ -0,0 +1,5 @@
+from .readout import main
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+""" Байесовское сравнение конверсий (см. bayesian ab testing.ipynb)
+Вероятность того, что конверсия одного варианта выше другого, по точной формуле для двух бета-распределений.
+Ряд из ноутбука считается векторно через логарифм гамма-функции, без numba и цикла по членам ряда.
+"""
+
+import numpy as np
+from scipy.special import gammaln
+
+from .result_cache import cached
+
+
+# Членов ряда за один шаг, чтобы для миллионов показов не держать в памяти весь ряд
+_CHUNK = 1 << 20
+
+
+def g(a, b, c, d) -> float:
+    """
+    Вероятность P(X > Y) для X ~ Beta(a, b), Y ~ Beta(c, d)
+    @rtype: float
+    """
+    total = np.exp(gammaln(a + b) + gammaln(a + c) - (gammaln(a + b + c) + gammaln(a)))
+    const = gammaln(a + c) + gammaln(a + b) - gammaln(a) - gammaln(b) - gammaln(c)
+    # Члены ряда h(a, b, c, j) / j для j = d - 1, d - 2, ... > 0, как в hiter из ноутбука
+    steps = int(np.ceil(d - 1)) if d > 1 else 0
+    for start in range(1, steps + 1, _CHUNK):
+        j = d - np.arange(start, min(start + _CHUNK, steps + 1), dtype=np.float64)
+        log_h = const + gammaln(b + j) + gammaln(c + j) - gammaln(j) - gammaln(a + b + c + j)
+        total += np.sum(np.exp(log_h) / j)
+    return float(total)
+
+
+@cached()
+def calc_prob_between(beta1, beta2) -> float:
+    """
+    Вероятность того, что значение из beta1 больше значения из beta2
+    @param beta1: Распределение scipy.stats.beta(a, b)
+    @param beta2: Распределение scipy.stats.beta(c, d)
+    @rtype: float
+    """
+    return g(beta1.args[0], beta1.args[1], beta2.args[0], beta2.args[1])
+
+
+@cached()
+def prob_test_better(conversions_test, units_test, conversions_control, units_control) -> float:
+    """
+    Вероятность того, что конверсия теста выше конверсии контроля, при равномерном априорном Beta(1, 1)
+    @param conversions_test: Число конверсий в тесте
+    @type conversions_test: int
+    @param units_test: Число пользователей в тесте
+    @type units_test: int
+    @param conversions_control: Число конверсий в контроле
+    @type conversions_control: int
+    @param units_control: Число пользователей в контроле
+    @type units_control: int
+    @rtype: float
+    """
+    return g(conversions_test + 1, units_test - conversions_test + 1,
+             conversions_control + 1, units_control - conversions_control + 1)
@@ -0,0 +1,168 @@
+""" Критерий Манна-Уитни по гистограммам значений
+Каждая выборка сжимается в пары (значение, число повторов), U, поправка на связки и p-value считаются по
+объединенной гистограмме за O(число различных значений), без ранжирования каждого элемента. Для выручки
+с миллионами нулей это на порядки быстрее и экономнее по памяти, чем scipy.stats.mannwhitneyu.
+p-value - нормальное приближение с поправкой на связки (как method='asymptotic' в scipy), поэтому путь
+предназначен для больших выборок.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+from scipy.stats import norm
+
+
+MannWhitneyResult = namedtuple('MannWhitneyResult', ['statistic', 'pvalue'])
+
+_ALTERNATIVES = ('two-sided', 'less', 'greater')
+
+
+def value_counts(values) -> tuple:
+    """
+    Гистограмма выборки: отсортированные различные значения и число повторов, пропуски отбрасываются.
+    Нули считаются отдельно, поэтому сортируются только ненулевые значения
+    @param values: Значения
+    @type values: np.ndarray
+    @return: Значения и число повторов
+    @rtype: tuple
+    """
+    values = np.asarray(values)
+    if values.dtype.kind == 'f':
+        values = values[~np.isnan(values)]
+    nonzero = values[values != 0]
+    unique, counts = np.unique(nonzero, return_counts=True)
+    zeros = values.shape[0] - nonzero.shape[0]
+    if zeros:
+        position = np.searchsorted(unique, 0)
+        unique = np.insert(unique, position, 0)
+        counts = np.insert(counts, position, zeros)
+    return unique, counts
+
+
+def mannwhitneyu_counts(values_1, counts_1, values_2, counts_2, alternative='two-sided',
+                        use_continuity=True) -> MannWhitneyResult:
+    """
+    Критерий Манна-Уитни по гистограммам двух выборок
+    @param values_1: Различные значения первой выборки
+    @type values_1: np.ndarray
+    @param counts_1: Число повторов значений первой выборки
+    @type counts_1: np.ndarray
+    @param values_2: Различные значения второй выборки
+    @type values_2: np.ndarray
+    @param counts_2: Число повторов значений второй выборки
+    @type counts_2: np.ndarray
+    @param alternative: 'two-sided', 'less' или 'greater' - как в scipy.stats.mannwhitneyu
+    @type alternative: str
+    @param use_continuity: Поправка на непрерывность
+    @type use_continuity: bool
+    @return: U первой выборки и p-value
+    @rtype: MannWhitneyResult
+    """
+    if alternative not in _ALTERNATIVES:
+        raise ValueError(f"alternative must be one of {_ALTERNATIVES}, got {alternative!r}")
+    counts_1 = np.asarray(counts_1, dtype=np.float64)
+    counts_2 = np.asarray(counts_2, dtype=np.float64)
+    n1 = counts_1.sum()
+    n2 = counts_2.sum()
+    if n1 == 0 or n2 == 0:
+        raise ValueError("both samples must be non-empty")
+
+    # Объединенная гистограмма: число повторов каждого значения в обеих выборках
+    merged = np.union1d(values_1, values_2)
+    merged_1 = np.zeros(merged.shape[0])
+    merged_2 = np.zeros(merged.shape[0])
+    merged_1[np.searchsorted(merged, values_1)] = counts_1
+    merged_2[np.searchsorted(merged, values_2)] = counts_2
+    ties = merged_1 + merged_2
+
+    # Средний ранг группы связанных значений: число меньших значений + (t + 1) / 2
+    mid_ranks = np.cumsum(ties) - ties + (ties + 1) / 2
+    u1 = np.dot(merged_1, mid_ranks) - n1 * (n1 + 1) / 2
+    u2 = n1 * n2 - u1
+
+    n = n1 + n2
+    tie_term = np.dot(ties, ties * ties - 1)
+    mu = n1 * n2 / 2
+    sigma = np.sqrt(n1 * n2 / 12 * ((n + 1) - tie_term / (n * (n - 1))))
+
+    u = {'two-sided': max(u1, u2), 'greater': u1, 'less': u2}[alternative]
+    if sigma == 0:
+        # Все значения одинаковы - различий нет
+        return MannWhitneyResult(float(u1), 1.0)
+    z = (u - mu - (0.5 if use_continuity else 0)) / sigma
+    pvalue = norm.sf(z)
+    if alternative == 'two-sided':
+        pvalue *= 2
+    return MannWhitneyResult(float(u1), float(np.clip(pvalue, 0, 1)))
+
+
+def mannwhitneyu(x, y, alternative='two-sided', use_continuity=True) -> MannWhitneyResult:
+    """
+    Критерий Манна-Уитни для двух выборок через гистограммы значений
+    @param x: Первая выборка
+    @param y: Вторая выборка
+    @param alternative: 'two-sided', 'less' или 'greater'
+    @type alternative: str
+    @param use_continuity: Поправка на непрерывность
+    @type use_continuity: bool
+    @return: U выборки x и p-value
+    @rtype: MannWhitneyResult
+    """
+    return mannwhitneyu_counts(*value_counts(x), *value_counts(y), alternative=alternative,
+                               use_continuity=use_continuity)
+
+
+def mannwhitneyu_batch(df, metrics, variant_column='variant', control=None, segment_columns=(),
+                       alternative='two-sided'):
+    """
+    Критерий Манна-Уитни для всех пар метрика x сегмент: каждый вариант против контроля.
+    Гистограммы всех сегментов и вариантов метрики строятся одной группировкой
+    @param df: Фрейм по unit с колонками вариантов, сегментов и метрик
+    @type df: pd.DataFrame
+    @param metrics: Метрики
+    @type metrics: list
+    @param variant_column: Колонка варианта
+    @type variant_column: str
+    @param control: Контрольный вариант, по умолчанию первый по порядку
+    @param segment_columns: Колонки сегментов, например ['platform', 'country']
+    @type segment_columns: list
+    @param alternative: 'two-sided', 'less' или 'greater'
+    @type alternative: str
+    @return: Фрейм: сегменты, metric, control, variant, units_control, units_variant, mw_u, mw_p_value
+    @rtype: pd.DataFrame
+    """
+    import pandas as pd
+
+    segment_columns = list(segment_columns)
+    rows = []
+    for metric in metrics:
+        counts = df.groupby([*segment_columns, variant_column, metric], observed=True).size().rename('count')
+        counts = counts[counts > 0].reset_index()
+        segments = counts.groupby(segment_columns, observed=True, sort=True) if segment_columns else [((), counts)]
+        for segment, segment_counts in segments:
+            segment = segment if isinstance(segment, tuple) else (segment,)
+            histograms = {
+                variant: (group[metric].to_numpy(), group['count'].to_numpy())
+                for variant, group in segment_counts.groupby(variant_column, observed=True, sort=True)
+            }
+            variants = sorted(histograms, key=str)
+            segment_control = variants[0] if control is None else control
+            if segment_control not in histograms:
+                continue
+            for variant in variants:
+                if variant == segment_control:
+                    continue
+                result = mannwhitneyu_counts(*histograms[variant], *histograms[segment_control],
+                                             alternative=alternative)
+                rows.append({
+                    **dict(zip(segment_columns, segment)),
+                    'metric': metric,
+                    'control': segment_control,
+                    'variant': variant,
+                    'units_control': int(histograms[segment_control][1].sum()),
+                    'units_variant': int(histograms[variant][1].sum()),
+                    'mw_u': result.statistic,
+                    'mw_p_value': result.pvalue,
+                })
+    return pd.DataFrame(rows, columns=[*segment_columns, 'metric', 'control', 'variant', 'units_control',
+                                       'units_variant', 'mw_u', 'mw_p_value'])
@@ -0,0 +1,224 @@
+""" Ежедневный расчет результатов многих экспериментов
+Вход - длинная таблица Parquet/CSV с колонками experiment, variant, unit и значениями метрик: либо по колонке
+на метрику, либо парой колонок metric, value. Строки одного unit суммируются, отсутствующая у unit
+метрика считается нулем. Для каждого эксперимента, метрики
+и тестового варианта против контроля считаются бутстрэп разницы средних, Манн-Уитни и байесовская вероятность
+того, что доля unit с ненулевой метрикой (конверсия) в тесте выше. Эксперименты распределяются по процессам,
+результат - одна сводная таблица.
+
+    python -m Statistic experiments.parquet --output readout.csv --jobs 8
+"""
+
+import os
+import time
+import logging
+import argparse
+
+
+_ID_COLUMNS = ['experiment', 'variant', 'unit']
+_RESULT_COLUMNS = [
+    'experiment', 'metric', 'control', 'variant', 'units_control', 'units_variant', 'mean_control', 'mean_variant',
+    'lift', 'boot_diff', 'boot_ci_low', 'boot_ci_high', 'boot_p_value', 'mw_u', 'mw_p_value',
+    'conversion_control', 'conversion_variant', 'prob_variant_better', 'seconds',
+]
+
+
+def read_experiments(path, metrics=None):
+    """
+    Чтение длинной таблицы экспериментов в таблицу unit x метрика
+    @param path: Файл .parquet или .csv
+    @type path: str
+    @param metrics: Метрики для расчета, по умолчанию все
+    @type metrics: list
+    @return: Фрейм с колонками experiment, variant, unit и по колонке на метрику
+    @rtype: pd.DataFrame
+    """
+    import pandas as pd
+
+    if path.endswith('.parquet'):
+        df = pd.read_parquet(path)
+    else:
+        df = pd.read_csv(path)
+    missing = [column for column in _ID_COLUMNS if column not in df.columns]
+    if missing:
+        raise ValueError(f"{path}: missing columns {missing}")
+
+    if 'metric' in df.columns and 'value' in df.columns:
+        if metrics:
+            df = df[df['metric'].isin(metrics)]
+        # Нет строки метрики у unit - значение метрики 0 (например, нет строки выручки - выручки не было)
+        df = df.pivot_table(index=_ID_COLUMNS, columns='metric', values='value', aggfunc='sum', observed=True,
+                            fill_value=0)
+        df.columns.name = None
+        return df.reset_index()
+
+    value_columns = metrics or [
+        column for column in df.columns
+        if column not in _ID_COLUMNS and pd.api.types.is_numeric_dtype(df[column])
+    ]
+    return df.groupby(_ID_COLUMNS, as_index=False, observed=True, sort=False)[value_columns].sum()
+
+
+def _compare(metric, control, variant, values_control, values_variant, boot_it, conf_level, seed) -> dict:
+    import numpy as np
+    from .Bootstrap import bootstrap_diff
+    from .rank_tests import mannwhitneyu
+    from .bayesian import prob_test_better
+
+    mean_control = float(np.mean(values_control))
+    mean_variant = float(np.mean(values_variant))
+    booted = bootstrap_diff(values_variant, values_control, boot_it=boot_it, bootstrap_conf_level=conf_level,
+                            random_state=seed, progress=False)
+    mw = mannwhitneyu(values_variant, values_control, alternative='two-sided')
+    conversions_control = int(np.count_nonzero(values_control))
+    conversions_variant = int(np.count_nonzero(values_variant))
+    return {
+        'metric': metric,
+        'control': control,
+        'variant': variant,
+        'units_control': len(values_control),
+        'units_variant': len(values_variant),
+        'mean_control': mean_control,
+        'mean_variant': mean_variant,
+        'lift': (mean_variant - mean_control) / mean_control if mean_control else np.nan,
+        'boot_diff': float(np.mean(booted['boot_data'])),
+        'boot_ci_low': float(booted['ci'].iloc[0, 0]),
+        'boot_ci_high': float(booted['ci'].iloc[1, 0]),
+        'boot_p_value': float(booted['p_value']),
+        'mw_u': float(mw.statistic),
+        'mw_p_value': float(mw.pvalue),
+        'conversion_control': conversions_control / len(values_control),
+        'conversion_variant': conversions_variant / len(values_variant),
+        'prob_variant_better': prob_test_better(conversions_variant, len(values_variant),
+                                                conversions_control, len(values_control)),
+    }
+
+
+def analyze_experiment(experiment, df, metrics, control=None, boot_it=3000, conf_level=0.95, seed=0) -> tuple:
+    """
+    Расчет одного эксперимента: каждый вариант против контроля по каждой метрике
+    @param experiment: Название эксперимента
+    @param df: Строки эксперимента из read_experiments
+    @type df: pd.DataFrame
+    @param metrics: Метрики
+    @type metrics: list
+    @param control: Контрольный вариант, по умолчанию первый по порядку. Если заданного варианта нет
+        в эксперименте, эксперимент пропускается
+    @param boot_it: Количество бутстрэп-подвыборок
+    @type boot_it: int
+    @param conf_level: Уровень доверия интервала бутстрэпа
+    @type conf_level: float
+    @param seed: seed бутстрэпа, при одинаковом seed и данных результат берется из кэша
+    @type seed: int
+    @return: Название эксперимента, строки результата и время расчета в секундах
+    @rtype: tuple
+    """
+    started = time.perf_counter()
+    variants = sorted(df['variant'].unique(), key=str)
+    if control is None:
+        control = variants[0]
+    else:
+        # --control приходит строкой, а варианты из CSV могут быть числами
+        matches = [variant for variant in variants if str(variant) == str(control)]
+        if not matches:
+            logging.warning(f"{experiment}: control {control} not in variants {variants}, experiment is skipped")
+            return experiment, [], time.perf_counter() - started
+        control = matches[0]
+    rows = []
+    for metric in metrics:
+        values = {variant: group[metric].dropna().to_numpy() for variant, group in df.groupby('variant')}
+        for variant in variants:
+            if variant == control:
+                continue
+            if len(values[control]) < 2 or len(values[variant]) < 2:
+                logging.warning(f"{experiment}: not enough units for {metric} {variant} vs {control}")
+                continue
+            rows.append({'experiment': experiment, **_compare(metric, control, variant, values[control],
+                                                              values[variant], boot_it, conf_level, seed)})
+    seconds = time.perf_counter() - started
+    for row in rows:
+        row['seconds'] = seconds
+    return experiment, rows, seconds
+
+
+def run_readout(df, metrics, jobs=None, control=None, boot_it=3000, conf_level=0.95, seed=0):
+    """
+    Расчет всех экспериментов в пуле процессов
+    @param df: Фрейм из read_experiments
+    @type df: pd.DataFrame
+    @param metrics: Метрики
+    @type metrics: list
+    @param jobs: Число процессов, по умолчанию по числу CPU, 1 - без пула
+    @type jobs: int
+    @return: Сводная таблица результатов
+    @rtype: pd.DataFrame
+    """
+    import pandas as pd
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    groups = list(df.groupby('experiment', sort=True, observed=True))
+    total = len(groups)
+    params = dict(control=control, boot_it=boot_it, conf_level=conf_level, seed=seed)
+    rows = []
+    started = time.perf_counter()
+
+    def report(done, experiment, seconds):
+        logging.info(f"[{done}/{total}] {experiment}: {seconds:.2f}s, elapsed {time.perf_counter() - started:.1f}s")
+
+    jobs = jobs or os.cpu_count()
+    if jobs == 1 or total <= 1:
+        for done, (experiment, group) in enumerate(groups, 1):
+            experiment, experiment_rows, seconds = analyze_experiment(experiment, group, metrics, **params)
+            rows.extend(experiment_rows)
+            report(done, experiment, seconds)
+    else:
+        with ProcessPoolExecutor(max_workers=min(jobs, total)) as executor:
+            futures = [
+                executor.submit(analyze_experiment, experiment, group, metrics, **params)
+                for experiment, group in groups
+            ]
+            for done, future in enumerate(as_completed(futures), 1):
+                experiment, experiment_rows, seconds = future.result()
+                rows.extend(experiment_rows)
+                report(done, experiment, seconds)
+
+    logging.info(f"Finished {total} experiments in {time.perf_counter() - started:.1f}s")
+    result = pd.DataFrame(rows, columns=_RESULT_COLUMNS)
+    return result.sort_values(['experiment', 'metric', 'variant'], ignore_index=True)
+
+
+def write_results(result, path) -> None:
+    """
+    Запись сводной таблицы в .parquet или .csv. Файл пишется атомарно
+    """
+    tmp_path = f"{path}.tmp"
+    if path.endswith('.parquet'):
+        result.to_parquet(tmp_path, index=False)
+    else:
+        result.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m Statistic', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input', help='Длинная таблица .parquet или .csv')
+    parser.add_argument('--output', default='readout.csv', help='Сводная таблица .parquet или .csv')
+    parser.add_argument('--metrics', nargs='+', help='Метрики, по умолчанию все')
+    parser.add_argument('--control', help='Контрольный вариант, по умолчанию первый по порядку. '
+                        'Эксперименты без этого варианта пропускаются')
+    parser.add_argument('--jobs', type=int, help='Число процессов, по умолчанию по числу CPU')
+    parser.add_argument('--boot-it', type=int, default=3000, help='Количество бутстрэп-подвыборок')
+    parser.add_argument('--conf-level', type=float, default=0.95, help='Уровень доверия интервала бутстрэпа')
+    parser.add_argument('--seed', type=int, default=0, help='seed бутстрэпа')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    df = read_experiments(args.input, args.metrics)
+    metrics = args.metrics or [column for column in df.columns if column not in _ID_COLUMNS]
+    logging.info(f"Read {df.shape[0]} units, {df['experiment'].nunique()} experiments, metrics {metrics}")
+    result = run_readout(df, metrics, jobs=args.jobs, control=args.control, boot_it=args.boot_it,
+                         conf_level=args.conf_level, seed=args.seed)
+    write_results(result, args.output)
+    logging.info(f"Written {result.shape[0]} rows to {args.output}")
+    return result
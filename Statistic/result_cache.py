@@ -0,0 +1,306 @@
+""" Кэш результатов статистических расчетов на диске
+Ключ записи - хэш входных массивов и параметров расчета (статистика, число итераций, seed, уровень доверия,
+alpha), поэтому повторный расчет на тех же данных возвращается из кэша, а изменившиеся данные считаются заново.
+Размер кэша ограничен, при превышении удаляются давно не использованные записи.
+
+    from result_cache import cached
+
+    @cached()
+    def calc_prob_between(beta1, beta2):
+        ...
+
+Настраивается переменными окружения:
+    STATISTIC_CACHE_DIR - каталог кэша, по умолчанию ~/.cache/statistic
+    STATISTIC_CACHE_MAX_MB - предельный размер кэша в мегабайтах, по умолчанию 1024
+    STATISTIC_CACHE=0 - отключение кэша
+"""
+
+import os
+import pickle
+import hashlib
+import inspect
+import logging
+import threading
+from types import FunctionType
+from functools import wraps
+
+import numpy as np
+
+
+_CACHE_DIR = os.environ.get('STATISTIC_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'statistic'))
+_MAX_BYTES = int(os.environ.get('STATISTIC_CACHE_MAX_MB', 1024)) * 1024 * 1024
+_SUFFIX = '.pkl'
+# При превышении предела кэш сокращается до этой доли, чтобы вытеснение не запускалось на каждой записи
+_EVICT_TO = 0.9
+
+
+def enabled() -> bool:
+    return os.environ.get('STATISTIC_CACHE', '1') != '0'
+
+
+def _update(digest, value) -> None:
+    """
+    Добавление значения в хэш. Массивы хэшируются по байтам, поэтому ключ для миллионов значений
+    считается за доли секунды
+    """
+    if isinstance(value, np.ndarray):
+        digest.update(f"ndarray{value.dtype.str}{value.shape}".encode())
+        if value.dtype.hasobject:
+            digest.update(repr(value.tolist()).encode())
+        else:
+            digest.update(np.ascontiguousarray(value).view(np.uint8).data)
+    elif hasattr(value, 'columns') and hasattr(value, 'index'):
+        # pandas.DataFrame: имена колонок и значения по колонкам, без импорта pandas
+        digest.update(b'frame')
+        for column in value.columns:
+            _update(digest, column)
+            _update(digest, value[column].to_numpy())
+    elif hasattr(value, 'to_numpy'):
+        # pandas.Series и Index - только значения, как и в расчете
+        _update(digest, value.to_numpy())
+    elif hasattr(value, 'dist') and hasattr(value, 'args') and hasattr(value, 'kwds'):
+        # Замороженное распределение scipy.stats, например beta(a, b)
+        digest.update(f"dist{value.dist.name}".encode())
+        _update(digest, value.args)
+        _update(digest, value.kwds)
+    elif isinstance(value, (list, tuple)):
+        digest.update(f"{type(value).__name__}{len(value)}".encode())
+        for item in value:
+            _update(digest, item)
+    elif isinstance(value, dict):
+        digest.update(f"dict{len(value)}".encode())
+        for key in sorted(value, key=repr):
+            _update(digest, key)
+            _update(digest, value[key])
+    elif callable(value):
+        # Статистика (np.mean, np.median, lambda): имя и байткод, чтобы разные lambda не совпали
+        digest.update(f"func{getattr(value, '__module__', '')}.{getattr(value, '__qualname__', repr(value))}".encode())
+        function = _python_function(value)
+        if function is not None:
+            _update_code(digest, function.__code__, function.__globals__, function.__module__, set())
+    else:
+        digest.update(f"{type(value).__name__}:{value!r}".encode())
+
+
+def _python_function(value):
+    # Исходная функция за декораторами: cached/wraps (__wrapped__) и numba.jit (py_func)
+    for _ in range(10):
+        unwrapped = getattr(value, '__wrapped__', None) or getattr(value, 'py_func', None)
+        if unwrapped is None:
+            break
+        value = unwrapped
+    return value if isinstance(value, FunctionType) else None
+
+
+def _update_code(digest, code, namespace, module, seen) -> None:
+    """
+    Хэш кода функции вместе с именами, к которым она обращается (np.mean и np.median различаются только
+    co_names), и кодом вызываемых функций того же модуля, поэтому правка вспомогательной функции
+    (например g в bayesian.py или в ноутбуке) тоже меняет ключ. Функции библиотек учитываются по имени
+    """
+    digest.update(code.co_code)
+    digest.update(repr(code.co_names).encode())
+    for const in code.co_consts:
+        # Вложенные функции и генераторы - тоже объекты кода, их repr содержит адрес в памяти
+        if hasattr(const, 'co_code'):
+            _update_code(digest, const, namespace, module, seen)
+        else:
+            digest.update(repr(const).encode())
+    for name in code.co_names:
+        callee = _python_function(namespace.get(name))
+        if callee is None or callee.__module__ != module or callee.__code__ in seen:
+            continue
+        seen.add(callee.__code__)
+        digest.update(f"callee{name}".encode())
+        _update_code(digest, callee.__code__, callee.__globals__, module, seen)
+
+
+def fingerprint(*values) -> str:
+    """
+    Ключ кэша по входным данным и параметрам
+    @param values: Массивы (numpy, pandas), распределения scipy, функции, скаляры и их коллекции
+    @return: Шестнадцатеричный хэш
+    @rtype: str
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for value in values:
+        _update(digest, value)
+    return digest.hexdigest()
+
+
+def _path(key, cache_dir) -> str:
+    return os.path.join(cache_dir, key[:2], key + _SUFFIX)
+
+
+def get(key, cache_dir=None) -> tuple:
+    """
+    Чтение записи кэша
+    @param key: Ключ из fingerprint
+    @type key: str
+    @param cache_dir: Каталог кэша, по умолчанию STATISTIC_CACHE_DIR
+    @type cache_dir: str
+    @return: Признак наличия записи и значение
+    @rtype: tuple
+    """
+    path = _path(key, cache_dir or _CACHE_DIR)
+    try:
+        with open(path, 'rb') as cache_file:
+            value = pickle.load(cache_file)
+    except FileNotFoundError:
+        return False, None
+    except Exception as e:
+        logging.warning(f"Broken cache entry {path}: {e}")
+        return False, None
+    try:
+        # Время изменения файла - время последнего использования записи, по нему вытесняются старые записи
+        os.utime(path)
+    except OSError:
+        pass
+    return True, value
+
+
+def put(key, value, cache_dir=None) -> None:
+    """
+    Запись в кэш. Файл пишется атомарно, поэтому параллельные процессы не читают недописанных записей
+    @param key: Ключ из fingerprint
+    @type key: str
+    @param value: Сохраняемый результат
+    @param cache_dir: Каталог кэша, по умолчанию STATISTIC_CACHE_DIR
+    @type cache_dir: str
+    """
+    cache_dir = cache_dir or _CACHE_DIR
+    path = _path(key, cache_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as cache_file:
+            pickle.dump(value, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        logging.warning(f"Failed to write cache entry {path}: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return
+    _track_size(cache_dir, os.path.getsize(path))
+
+
+# Оценка размера кэша в этом процессе: каталог сканируется при первой записи и при превышении предела,
+# а не на каждой записи. Записи других процессов учитываются при следующем сканировании
+_sizes = {}
+_sizes_lock = threading.Lock()
+
+
+def _track_size(cache_dir, written) -> None:
+    with _sizes_lock:
+        if cache_dir not in _sizes:
+            _sizes[cache_dir] = sum(size for _, size, _ in _entries(cache_dir))
+        else:
+            _sizes[cache_dir] += written
+        if _sizes[cache_dir] <= _MAX_BYTES:
+            return
+        _sizes[cache_dir] = _evict(cache_dir, int(_MAX_BYTES * _EVICT_TO))[1]
+
+
+def _entries(cache_dir) -> list:
+    entries = []
+    if not os.path.isdir(cache_dir):
+        return entries
+    for bucket in os.scandir(cache_dir):
+        if not bucket.is_dir():
+            continue
+        for entry in os.scandir(bucket.path):
+            if not entry.name.endswith(_SUFFIX):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    return entries
+
+
+def evict(cache_dir=None, max_bytes=None) -> int:
+    """
+    Удаление давно не использованных записей, пока размер кэша больше предельного
+    @param cache_dir: Каталог кэша, по умолчанию STATISTIC_CACHE_DIR
+    @type cache_dir: str
+    @param max_bytes: Предельный размер, по умолчанию STATISTIC_CACHE_MAX_MB
+    @type max_bytes: int
+    @return: Число удаленных записей
+    @rtype: int
+    """
+    max_bytes = _MAX_BYTES if max_bytes is None else max_bytes
+    cache_dir = cache_dir or _CACHE_DIR
+    removed, total = _evict(cache_dir, max_bytes)
+    with _sizes_lock:
+        _sizes[cache_dir] = total
+    return removed
+
+
+def _evict(cache_dir, max_bytes) -> tuple:
+    entries = _entries(cache_dir)
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        removed += 1
+    return removed, total
+
+
+def clear(cache_dir=None) -> int:
+    """
+    Удаление всех записей кэша
+    @return: Число удаленных записей
+    @rtype: int
+    """
+    return evict(cache_dir, max_bytes=0)
+
+
+def cached(name=None, ignore=(), requires=(), version=None):
+    """
+    Декоратор кэширования результата функции по ее аргументам
+    @param name: Название расчета в ключе, по умолчанию модуль и имя функции
+    @type name: str
+    @param ignore: Аргументы, не влияющие на результат (например вывод прогресса)
+    @type ignore: tuple
+    @param requires: Аргументы, без которых результат не кэшируется, например seed случайного расчета:
+        при seed=None каждый запуск дает новый результат
+    @type requires: tuple
+    @param version: Версия расчета, меняется при изменении алгоритма, чтобы не читать старые записи
+    @type version: str
+    """
+
+    def decorator(func):
+        signature = inspect.signature(func)
+        calc_name = name or f"{func.__module__}.{func.__qualname__}"
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled():
+                return func(*args, **kwargs)
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            if any(bound.arguments.get(param) is None for param in requires):
+                return func(*args, **kwargs)
+            params = {param: value for param, value in bound.arguments.items() if param not in ignore}
+            # Байткод функции и вызываемых ею функций модуля входит в ключ:
+            # после правки расчета (в том числе в ноутбуке) старые записи не читаются
+            key = fingerprint(calc_name, version, func, params)
+            hit, value = get(key)
+            if hit:
+                logging.debug(f"{calc_name}: cache hit {key}")
+                return value
+            value = func(*args, **kwargs)
+            put(key, value)
+            return value
+
+        wrapper.uncached = func
+        return wrapper
+
+    return decorator